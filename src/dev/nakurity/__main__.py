@@ -1,6 +1,7 @@
 # src/dev/nakurity/__main__.py
 import asyncio
 import signal
+from typing import Any, NamedTuple
 
 from .intermediary import Intermediary
 from .server import NakurityBackend
@@ -23,198 +24,57 @@ cfg = load_config()
 import os
 print("PID:", os.getpid())
 
-import re
 import sys
-import linecache
-import inspect
-import time
-from pathlib import Path
-from datetime import datetime
 
-# === CONFIGURATION ===
-PROJECT_ROOT = Path(__file__).parents[2].resolve()
-LOG_PATH = PROJECT_ROOT / "trace_debug.log"
-
-USE_COLOR = True
-SHOW_FILE_PATH = False
-SHOW_TIMESTAMP = True
-MAX_VALUE_LEN = 60
-MAX_LOCALS = 4
-MAX_STACK_DEPTH = 12
-
-start_time = time.perf_counter()
-
-# === COLOR UTILITIES ===
-def color(txt, fg=None, style=None):
-    if not USE_COLOR:
-        return txt
-    codes = {
-        "reset": "\033[0m", "bold": "\033[1m",
-        "gray": "\033[90m", "red": "\033[91m",
-        "green": "\033[92m", "yellow": "\033[93m",
-        "blue": "\033[94m", "magenta": "\033[95m",
-        "cyan": "\033[96m",
-    }
-    return f"{codes.get(style, '')}{codes.get(fg, '')}{txt}{codes['reset']}"
-
-# === FORMATTING HELPERS ===
-def short(v):
-    s = repr(v)
-    return s if len(s) <= MAX_VALUE_LEN else s[:MAX_VALUE_LEN - 3] + "..."
-
-def now():
-    return f"{(time.perf_counter() - start_time):6.3f}s"
-
-def fmt_path(rel, lineno):
-    if SHOW_FILE_PATH:
-        return f"{rel}:{lineno}"
-    return f"{rel.name}:{lineno}"
-
-def fmt_locals(locals_dict):
-    items = [
-        f"{color(k, 'blue')}={color(short(v), 'gray')}"
-        for k, v in locals_dict.items()
-        if not k.startswith("__") and not inspect.isfunction(v)
-    ]
-    return ", ".join(items[:MAX_LOCALS])
-
-def write_log(line):
-    with open(LOG_PATH, "a", encoding="utf-8") as f:
-        f.write(line + "\n")
-
-# === MAIN TRACER ===
-TRACE_INCLUDE = ["src/dev/nakurity", "src/dev/tests"]
-TRACE_EVENTS = {"call", "return", "exception", "line"}  # include line events for verbose debugging
-TRACE_EXCLUDE_FUNCS = {"write_log", "trace"}
-
-def plain(txt):
-    """Strip ANSI codes for file output."""
-    return re.sub(r"\x1b\[[0-9;]*m", "", txt)
-
-def trace(frame, event, arg):
-    try:
-        filename = Path(frame.f_code.co_filename).resolve()
-    except Exception:
-        return
-
-    try:
-        filename.relative_to(PROJECT_ROOT)
-    except ValueError:
-        return
-
-    rel = filename.relative_to(PROJECT_ROOT)
-    rel_posix = rel.as_posix()
-    func = frame.f_code.co_name
-    depth = len(inspect.stack(0)) - 1
-    indent = "│  " * (depth % MAX_STACK_DEPTH)
-    ts = f"[{now()}]" if SHOW_TIMESTAMP else ""
-
-    def log(msg, newline=False):
-        clean = plain(msg)
-        if newline:
-            print()
-            write_log("")
-        print(msg)
-        write_log(clean)
-
-    # === CALL ===
-    if event == "call":
-        args, _, _, values = inspect.getargvalues(frame)
-        arg_str = ", ".join(f"{a}={short(values[a])}" for a in args if a in values)
-        header = (
-            f"\n{indent}{color('╭▶', 'cyan', 'bold')} "
-            f"{color(func, 'green', 'bold')}() "
-            f"{color(fmt_path(rel, frame.f_lineno), 'gray')} {ts}"
-        )
-        log(header, newline=True)
-        if arg_str:
-            log(f"{indent}{color('│ args:', 'yellow')} {arg_str}")
-
-    # === LINE ===
-    elif event == "line":
-        line = linecache.getline(str(filename), frame.f_lineno).strip()
-        msg = f"{indent}{color('│ →', 'cyan')} {line}"
-        log(msg)
-        local_vars = fmt_locals(frame.f_locals)
-        if local_vars:
-            log(f"{indent}{color('│ • locals:', 'gray')} {local_vars}")
-
-    # === RETURN ===
-    elif event == "return":
-        msg = (
-            f"{indent}{color('╰↩', 'green', 'bold')} "
-            f"{color('return', 'gray')} {short(arg)} {ts}"
-        )
-        log(msg)
-
-    # === EXCEPTION ===
-    elif event == "exception":
-        exc_type, exc_value, _ = arg
-        msg = (
-            f"{indent}{color('💥', 'red', 'bold')} "
-            f"{exc_type.__name__}: {exc_value}  "
-            f"{color(fmt_path(rel, frame.f_lineno), 'gray')}"
-        )
-        log(msg, newline=True)
-
-    return trace
-
-# Apply trace configuration from config.yaml
-from ..utils.config_loader import get_config_loader, apply_trace_config
+# Tracing is opt-in: the tracer module is only imported when enabled
+from ..utils.config_loader import get_config_loader
 config_loader = get_config_loader()
-apply_trace_config(trace)
-if config_loader.is_trace_enabled():
+config_loader.setup_logging()
+if config_loader.is_trace_enabled() or os.environ.get("NAKURITY_TRACE") == "1":
+    from ..utils.smarttrace import trace, color
+    sys.settrace(trace)
     print(color(f"🧠 SmartTrace enabled", "magenta", "bold"))
 else:
-    print(color(f"🧠 SmartTrace disabled by configuration", "yellow", "bold"))
-
-HOST = {
-    "intermediary": cfg.get("intermediary", {}).get("host", "127.0.0.1"),
-    "nakurity-backend": cfg.get("nakurity-backend", {}).get("host", "127.0.0.1"),
-    "nakurity-client": cfg.get("nakurity-client", {}).get("host", "127.0.0.1"),
-}
-PORT = {
-    "intermediary": int(cfg.get("intermediary", {}).get("port", 8765)),
-    "nakurity-backend": int(cfg.get("nakurity-backend", {}).get("port", 8001)),
-    "nakurity-client": int(cfg.get("nakurity-client", {}).get("port", 8000)),
-}
+    print("🧠 SmartTrace disabled by configuration")
+
+class _Services(NamedTuple):
+    """Per-service value; a typo in a field name fails at attribute lookup."""
+    intermediary: Any
+    nakurity_backend: Any
+    nakurity_client: Any
+
+def _section(name: str) -> dict:
+    return cfg.get(name, {}) or {}
+
+HOST = _Services(
+    intermediary=_section("intermediary").get("host", "127.0.0.1"),
+    nakurity_backend=_section("nakurity-backend").get("host", "127.0.0.1"),
+    nakurity_client=_section("nakurity-client").get("host", "127.0.0.1"),
+)
+PORT = _Services(
+    intermediary=int(_section("intermediary").get("port", 8765)),
+    nakurity_backend=int(_section("nakurity-backend").get("port", 8001)),
+    nakurity_client=int(_section("nakurity-client").get("port", 8000)),
+)
+
+class _Shutdown(Exception):
+    """Raised inside main()'s task group to cancel every relay service at once."""
+
+async def _optional(name: str, coro):
+    """Run an optional service; log its failure instead of tearing down the relay."""
+    try:
+        await coro
+    except Exception as e:
+        print(f"[Main] {name} failed: {e!r}")
 
 async def main():
-    intermediary = Intermediary(host=HOST.get("intermediary"), port=PORT.get("intermediary"))
+    intermediary = Intermediary(host=HOST.intermediary, port=PORT.intermediary)
     nakurity_backend = NakurityBackend(intermediary)
 
-    # start intermediary first and wait for it to be listening
-    intermediary_task = await intermediary.start()
-
-    # Set timeout for intermediary, incase it takes too long to start.
-    # if that happens, something is wrong
-    try:
-        await intermediary.wait_until_ready(timeout=5.0)
-    except asyncio.TimeoutError:
-        print("[Error] intermediary failed to start within timeout")
-        return
-    
-    # now start the backend (it will be able to connect to the intermediary or be discoverable)
-    nakurity_task = asyncio.create_task(nakurity_backend.run_server(
-        host=HOST.get("nakurity-backend"),
-        port=PORT.get("nakurity-backend")
-    ))
-
-    tasks = [intermediary_task, nakurity_task] 
-
-    # Optional: start intercept proxy if enabled in config
-    ip_cfg = cfg.get("intercept-proxy", {}) or {}
-    if ip_cfg.get("enabled", False):
-        proxy = InterceptProxy(config_from_yaml())
-        proxy_task = asyncio.create_task(proxy.start())
-        tasks.append(proxy_task)
-        print("[Main] InterceptProxy enabled and starting")
-
     # start nakurity client (outbound) as a background task, give it a forwarding callback
     # We pass the backend's intermediary forwarder so inbound messages from the real Neuro
     # are forwarded into the relay pipeline.
-    outbound_uri = f"ws://{HOST.get('nakurity-client')}:{PORT.get('nakurity-client')}"
-    # create a background task which will attach a NakurityClient to the loop
+    outbound_uri = f"ws://{HOST.nakurity_client}:{PORT.nakurity_client}"
     client = None
     nk_link = None
     reconnect_in_progress = False
@@ -229,7 +89,7 @@ async def main():
             # set up NakurityLink tied to the connected client and attach to intermediary
             nk_link = NakurityLink(client)
             intermediary.nakurity_outbound_client = nk_link
-            tasks.append(asyncio.create_task(nk_link.start()))
+            await nk_link.start()
             print("[Main] NakurityLink attached to intermediary")
             # Set up reconnection callback
             client._reconnect_callback = reconnect_client
@@ -266,36 +126,60 @@ async def main():
         else:
             await setup_client_and_link(new_client)
 
-    outbound_task = asyncio.create_task(start_outbound())
-    tasks.append(outbound_task)
-
-    # graceful shutdown (cross-platform)
-    loop = asyncio.get_event_loop()
-    stop = loop.create_future()
-
-    def _stop(*_):
-        if not stop.done():
-            stop.set_result(True)
-
+    # asyncio.run() already turns Ctrl-C into cancellation of this task (on
+    # every platform); route SIGTERM the same way where the loop supports it.
     try:
-        loop.add_signal_handler(signal.SIGINT, _stop)
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGTERM, asyncio.current_task().cancel
+        )
     except NotImplementedError:
-        # Windows fallback: use add_reader on stdin
-        import threading
-        def wait_for_ctrl_c():
-            import time
-            try:
-                while True:
-                    time.sleep(0.2)
-            except KeyboardInterrupt:
-                _stop()
-        threading.Thread(target=wait_for_ctrl_c, daemon=True).start()
-
-    await stop
+        pass
+
+    # The services started here share one task group: a crash in the intermediary
+    # or backend, a _Shutdown raised here, or cancelling main() cancels and joins
+    # the rest. The optional proxy and outbound client only log their failures.
+    # Tasks the services spawn themselves (the client reader, NakurityLink's
+    # traffic task, the proxy's relay connection, the intermediary's
+    # wait_closed) are owned by them and not joined here.
+    try:
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(intermediary.start())
 
-    for t in tasks:
-        t.cancel()
-    await asyncio.gather(*tasks, return_exceptions=True)
+            # Set timeout for intermediary, incase it takes too long to start.
+            # if that happens, something is wrong
+            try:
+                await intermediary.wait_until_ready(timeout=5.0)
+            except asyncio.TimeoutError:
+                print("[Error] intermediary failed to start within timeout")
+                raise _Shutdown
+
+            # now start the backend (it will be able to connect to the intermediary or be discoverable)
+            tg.create_task(nakurity_backend.run_server(
+                host=HOST.nakurity_backend,
+                port=PORT.nakurity_backend
+            ))
+
+            # Optional: start intercept proxy if enabled in config
+            ip_cfg = cfg.get("intercept-proxy", {}) or {}
+            if ip_cfg.get("enabled", False):
+                proxy = InterceptProxy(config_from_yaml())
+                tg.create_task(_optional("InterceptProxy", proxy.start()))
+                print("[Main] InterceptProxy enabled and starting")
+
+            tg.create_task(_optional("outbound client", start_outbound()))
+    except* _Shutdown:
+        pass
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # uvloop is POSIX-only; fall back to the default selector loop elsewhere
+    if sys.platform != "win32":
+        try:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            print("[Main] using uvloop event loop")
+        except ImportError:
+            pass
+    try:
+        asyncio.run(main())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        print("[Main] shutting down")
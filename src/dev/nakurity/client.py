@@ -1,13 +1,33 @@
 # src/dev/nakurity/client.py
-import json
+import logging
+import random
+import orjson
 import websockets
 import asyncio
 from neuro_api.api import AbstractNeuroAPI, NeuroAction
+from ..utils.config_loader import get_websocket_options
+
+logger = logging.getLogger(__name__)
 
 """
 A Neuro client that connects out to a real Neuro backend.
 """
 
+def _build_action(action_name: str, action_info) -> dict:
+    """Convert one registry entry (schema dict or plain description) to Action format."""
+    if isinstance(action_info, dict):
+        return {
+            "name": action_name,
+            "description": action_info.get("description", f"Action: {action_name}"),
+            "schema": action_info.get("schema")
+        }
+    # Simple string description
+    return {
+        "name": action_name,
+        "description": str(action_info) if action_info else f"Action: {action_name}",
+        "schema": None
+    }
+
 class NakurityClient(AbstractNeuroAPI):
     def __init__(self, websocket, router_forward_cb):
         self.websocket = websocket
@@ -17,7 +37,7 @@ class NakurityClient(AbstractNeuroAPI):
         # e.g. intermediary._handle_intermediary_forward
         self.router_forward_cb = router_forward_cb
         self._reader_task: asyncio.Task | None = None
-        print("[Nakurity Client] has initialized.")
+        logger.debug("client initialized")
         #self._recv_q = asyncio.Queue()
 
     async def write_to_websocket(self, data: str):
@@ -31,10 +51,10 @@ class NakurityClient(AbstractNeuroAPI):
         # Send required startup to set game/title on backend
         try:
             await self.send_startup_command()
-            print("[Nakurity Client] Startup command sent successfully")
+            logger.info("startup command sent")
         except Exception as e:
-            print(f"[Nakurity Client] Warning: Failed to send startup command: {e}")
-            print("[Nakurity Client] Will continue - startup may be sent later if reconnected")
+            logger.warning("failed to send startup command: %s; "
+                           "continuing, startup may be sent again on reconnect", e)
         # Optional steps disabled to avoid schema mismatches with dev backends
         # actions_schema = await self.collect_registered_actions()
         # if actions_schema:
@@ -42,14 +62,9 @@ class NakurityClient(AbstractNeuroAPI):
 
     async def handle_action(self, action: NeuroAction):
         # Actions from real Neuro backend flow back to intermediary → integrations
-        print(f"[Nakurity Client] ========================================")
-        print(f"[Nakurity Client] RECEIVED ACTION FROM TONY (Neuro Backend)")
-        print(f"[Nakurity Client]   action.name: {action.name}")
-        print(f"[Nakurity Client]   action.id_: {action.id_}")
-        print(f"[Nakurity Client]   action.data: {action.data}")
-        print(f"[Nakurity Client] Forwarding to router_forward_cb...")
-        print(f"[Nakurity Client] ========================================")
-        
+        logger.debug("received action from Neuro backend: name=%s id=%s data=%s",
+                     action.name, action.id_, action.data)
+
         try:
             result = await self.router_forward_cb({
                 "from_neuro_backend": True,
@@ -57,7 +72,7 @@ class NakurityClient(AbstractNeuroAPI):
                 "data": action.data or "{}", #json.loads(action.data or "{}"),
                 "id": action.id_
             })
-            print(f"[Nakurity Client] router_forward_cb returned: {result}")
+            logger.debug("router_forward_cb returned: %s", result)
             
             # Send success result back to Tony
             # The integration should have executed the action
@@ -68,9 +83,7 @@ class NakurityClient(AbstractNeuroAPI):
             else:
                 await self.send_action_result(action.id_, True, "Action executed")
         except Exception as e:
-            print(f"[Nakurity Client] ERROR handling action: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("error handling action %s", action.name)
             await self.send_action_result(action.id_, False, f"Relay error: {str(e)}")
 
     async def collect_registered_actions(self):
@@ -79,31 +92,20 @@ class NakurityClient(AbstractNeuroAPI):
             resp = await self.router_forward_cb({"query": "get_registered_actions"})
             return resp.get("actions", {}) if isinstance(resp, dict) else {}
         except Exception as e:
-            print(f"[Nakurity Client] failed to collect actions: {e}")
+            logger.warning("failed to collect actions: %s", e)
             return {}
 
-    async def register_actions(self, actions_schema: dict):
-        """Register integration actions with Neuro backend."""
-        # Convert actions_schema dict to proper Action format
-        actions_list = []
-        for action_name, action_info in actions_schema.items():
-            if isinstance(action_info, dict):
-                action = {
-                    "name": action_name,
-                    "description": action_info.get("description", f"Action: {action_name}"),
-                    "schema": action_info.get("schema")
-                }
-            else:
-                # Simple string description
-                action = {
-                    "name": action_name,
-                    "description": str(action_info) if action_info else f"Action: {action_name}",
-                    "schema": None
-                }
-            actions_list.append(action)
+    async def register_actions(self, actions_schema):
+        """Register integration actions with Neuro backend.
+
+        Accepts the {name: info} dict from collect_registered_actions or any
+        iterable of (name, info) pairs.
+        """
+        items = actions_schema.items() if isinstance(actions_schema, dict) else actions_schema
+        actions_list = [_build_action(name, info) for name, info in items]
         
         if not actions_list:
-            print("[Nakurity Client] No actions to register")
+            logger.info("no actions to register")
             return
             
         payload = {
@@ -111,15 +113,15 @@ class NakurityClient(AbstractNeuroAPI):
             "game": self.name,
             "data": {"actions": actions_list}
         }
-        print(f"[Nakurity Client] Registering {len(actions_list)} actions with Neuro backend")
-        await self.send_command_data(json.dumps(payload).encode())
+        logger.info("registering %d actions with Neuro backend", len(actions_list))
+        await self.send_command_data(orjson.dumps(payload))
 
 
     async def on_connect(self):
-        print("[Nakurity Client] connected")
+        logger.info("connected")
 
     async def on_disconnect(self):
-        print("[Nakurity Client] disconnected")
+        logger.info("disconnected")
 
     async def send_to_neuro(self, command_bytes: bytes):
         """Send formatted neuro command bytes to the real neuro backend."""
@@ -130,12 +132,12 @@ class NakurityClient(AbstractNeuroAPI):
             while True:
                 await self.read_message()
         except websockets.exceptions.ConnectionClosed:
-            print("[Nakurity Client] connection closed")
+            logger.info("connection closed")
             # Signal that reconnection is needed
             if hasattr(self, '_reconnect_callback'):
                 asyncio.create_task(self._reconnect_callback())
         except Exception as e:
-            print("[Nakurity Client] read loop exception:", e)
+            logger.error("read loop exception: %s", e)
             # Signal that reconnection is needed
             if hasattr(self, '_reconnect_callback'):
                 asyncio.create_task(self._reconnect_callback())
@@ -146,33 +148,31 @@ async def connect_outbound(uri: str, router_forward_cb, max_retries: int = 10, r
     This function will create a background read loop for the websocket.
     """
     for attempt in range(max_retries):
-        print(f"[Nakurity Client] trying to connect to Neuro Backend (attempt {attempt + 1}/{max_retries})")
+        logger.info("trying to connect to Neuro backend (attempt %d/%d)", attempt + 1, max_retries)
         try:
-            ws = await websockets.connect(uri)
-            print(f"[Nakurity Client] successfully connected to {uri}")
+            ws = await websockets.connect(uri, **get_websocket_options())
+            logger.info("connected to %s", uri)
             break
         except Exception as e:
             if attempt == max_retries - 1:
-                print(f"[Nakurity Client] failed to connect after {max_retries} attempts: {uri}")
-                print(f"[Nakurity Client] final error: {e}")
+                logger.error("failed to connect to %s after %d attempts: %s", uri, max_retries, e)
                 return None
             else:
-                delay = retry_delay * (2 ** min(attempt, 6))  # Exponential backoff, max 128s
-                print(f"[Nakurity Client] connection failed: {e}")
-                print(f"[Nakurity Client] retrying in {delay:.1f}s...")
+                # Exponential backoff (capped at 2**6 steps) with jitter so relays
+                # restarted together don't retry in lockstep
+                delay = retry_delay * (2 ** min(attempt, 6)) * random.uniform(0.5, 1.5)
+                logger.warning("connection failed: %s; retrying in %.1fs", e, delay)
                 await asyncio.sleep(delay)
 
     try:
-        print("[Nakurity Client] starting connection to neuro backend", uri)
+        logger.debug("initializing client for %s", uri)
         c = NakurityClient(ws, router_forward_cb)
         await c.initialize()
         # start background read loop
-        loop = asyncio.get_event_loop()
-        c._reader_task = loop.create_task(c._read_loop())
+        c._reader_task = asyncio.create_task(c._read_loop())
         return c
     except Exception as e:
-        print("[Nakurity Client] has failed during initialize!")
-        print(e)
+        logger.exception("client failed during initialize")
         try:
             await ws.close()
         except Exception:
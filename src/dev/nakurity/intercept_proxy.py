@@ -1,11 +1,12 @@
 # src/dev/nakurity/intercept_proxy.py
 import asyncio
-import json
+import orjson
 from dataclasses import dataclass, field
 from typing import List, Optional
 
 import websockets
 
+from ..utils.config_loader import get_websocket_options
 from ..utils.loadconfig import load_config
 
 
@@ -40,15 +41,24 @@ class InterceptProxy:
 
     def __init__(self, cfg: InterceptProxyConfig):
         self.cfg = cfg
+        self._match_set = frozenset(cfg.match_commands)
+        # Only ever replaced wholesale, so reads and writes need no lock
         self._relay_ws: Optional[websockets.WebSocketClientProtocol] = None
-        self._relay_lock = asyncio.Lock()
         self._server = None
+        # Encoded events for the Intermediary; a slow relay link drops events
+        # instead of stalling the proxy pumps
+        self._outbox: asyncio.Queue[bytes] = asyncio.Queue(maxsize=1024)
+        self._outbox_dropped = 0
+        self._outbox_task: Optional[asyncio.Task] = None
 
     async def start(self):
         # Start background connection to Intermediary (optional)
         asyncio.create_task(self._ensure_intermediary_connected())
+        self._outbox_task = asyncio.create_task(self._outbox_writer())
         # Start proxy server
-        self._server = await websockets.serve(self._handle_client, self.cfg.listen_host, self.cfg.listen_port)
+        self._server = await websockets.serve(
+            self._handle_client, self.cfg.listen_host, self.cfg.listen_port, **get_websocket_options()
+        )
         print(f"[InterceptProxy] listening on ws://{self.cfg.listen_host}:{self.cfg.listen_port} -> {self.cfg.upstream_url}")
         await self._server.wait_closed()
 
@@ -59,41 +69,58 @@ class InterceptProxy:
             try:
                 uri = f"ws://{self.cfg.intermediary_host}:{self.cfg.intermediary_port}"
                 print(f"[InterceptProxy] connecting to Intermediary at {uri}...")
-                ws = await websockets.connect(uri)
-                await ws.send(json.dumps({
+                ws = await websockets.connect(uri, **get_websocket_options())
+                await ws.send(orjson.dumps({
                     "type": "integration",
                     "name": self.cfg.intermediary_integration_name,
                     "auth_token": self.cfg.intermediary_auth_token or "super-secret-token",
-                }))
-                async with self._relay_lock:
-                    self._relay_ws = ws
+                }), text=True)
+                self._relay_ws = ws
                 print("[InterceptProxy] connected to Intermediary (as integration '", self.cfg.intermediary_integration_name, "')")
-                # Keep this connection alive until closed
-                async for _ in ws:
+                # Keep this connection alive until closed. The Intermediary pushes
+                # broadcasts and queued messages here and replies on forward errors;
+                # drain them (undecoded) so they can't fill the receive queue and
+                # stall reads, pings included.
+                try:
+                    while True:
+                        await ws.recv(decode=False)
+                except websockets.exceptions.ConnectionClosedOK:
                     pass
             except Exception as e:
                 print(f"[InterceptProxy] Intermediary connection error: {e}")
             finally:
-                async with self._relay_lock:
-                    self._relay_ws = None
+                self._relay_ws = None
                 await asyncio.sleep(2.0)
 
-    async def _broadcast(self, payload: dict):
+    def _broadcast(self, payload: dict):
         # Send a message into Intermediary as if from an integration; the Intermediary will
         # fan out to Neuro-OS watchers via its existing 'integration_message' notifications.
-        async with self._relay_lock:
-            ws = self._relay_ws
-        if not ws:
+        if self._relay_ws is None:
             return
         try:
-            await ws.send(json.dumps(payload))
-        except Exception:
-            pass
+            self._outbox.put_nowait(orjson.dumps(payload))
+        except asyncio.QueueFull:
+            self._outbox_dropped += 1
+            if self._outbox_dropped % 100 == 1:
+                print(f"[InterceptProxy] Intermediary outbox full, {self._outbox_dropped} events dropped so far")
+
+    async def _outbox_writer(self):
+        while True:
+            frame = await self._outbox.get()
+            ws = self._relay_ws
+            if ws is None:
+                continue
+            try:
+                # text=True: the Intermediary treats binary frames as file uploads.
+                # One send per event; send(list) would fragment them into one message.
+                await ws.send(frame, text=True)
+            except Exception:
+                pass
 
     async def _handle_client(self, client_ws: websockets.WebSocketServerProtocol):
         # Connect upstream to real backend
         try:
-            upstream_ws = await websockets.connect(self.cfg.upstream_url)
+            upstream_ws = await websockets.connect(self.cfg.upstream_url, **get_websocket_options())
         except Exception as e:
             print(f"[InterceptProxy] failed to connect upstream {self.cfg.upstream_url}: {e}")
             await client_ws.close()
@@ -102,55 +129,67 @@ class InterceptProxy:
         client_peer = getattr(client_ws, 'remote_address', None)
         print(f"[InterceptProxy] client connected from {client_peer}")
 
-        async def pump_client_to_upstream():
-            async for message in client_ws:
-                # Inspect only text frames
-                if isinstance(message, (bytes, bytearray)):
-                    await upstream_ws.send(message)
-                    continue
-                try:
-                    obj = json.loads(message)
-                except Exception:
-                    obj = None
-                if isinstance(obj, dict):
-                    cmd = obj.get("command")
-                    if cmd and any(cmd == m for m in self.cfg.match_commands):
-                        await self._broadcast({
-                            "event": "integration_connected",
-                            "via": "intercept-proxy",
-                            "details": {
-                                "client": str(client_peer),
-                                "first_command": cmd,
-                                "snippet": obj.get("data") if isinstance(obj.get("data"), (dict, list, str)) else None,
-                            }
-                        })
-                await upstream_ws.send(message)
-
-        async def pump_upstream_to_client():
-            async for message in upstream_ws:
-                await client_ws.send(message)
-
         try:
-            await asyncio.wait(
-                [
-                    asyncio.create_task(pump_client_to_upstream()),
-                    asyncio.create_task(pump_upstream_to_client()),
-                ],
-                return_when=asyncio.FIRST_COMPLETED,
-            )
+            # Each pump closes the socket it writes to when it stops, which ends
+            # the opposite pump's read loop; the group then exits with both done.
+            async with asyncio.TaskGroup() as tg:
+                tg.create_task(self._pump_client_to_upstream(client_ws, upstream_ws, client_peer))
+                tg.create_task(self._pump_upstream_to_client(upstream_ws, client_ws))
+        except* websockets.exceptions.ConnectionClosed:
+            pass
+        except* Exception as eg:
+            print(f"[InterceptProxy] pump error for {client_peer}: {eg.exceptions}")
         finally:
             await asyncio.gather(
                 self._maybe_close(client_ws),
                 self._maybe_close(upstream_ws),
                 return_exceptions=True,
             )
-            await self._broadcast({
+            self._broadcast({
                 "event": "integration_disconnected",
                 "via": "intercept-proxy",
                 "details": {"client": str(client_peer)},
             })
             print(f"[InterceptProxy] client disconnected {client_peer}")
 
+    async def _pump_client_to_upstream(self, client_ws, upstream_ws, client_peer):
+        try:
+            async for message in client_ws:
+                # Binary frames and text without a "command" key pass straight
+                # through; only candidate frames pay for a parse
+                if type(message) is str and '"command"' in message:
+                    self._inspect_command(message, client_peer)
+                await upstream_ws.send(message)
+        finally:
+            await self._maybe_close(upstream_ws)
+
+    def _inspect_command(self, message: str, client_peer):
+        try:
+            obj = orjson.loads(message)
+        except orjson.JSONDecodeError:
+            return
+        if not isinstance(obj, dict):
+            return
+        cmd = obj.get("command")
+        # str check first: an unhashable "command" would break the set lookup
+        if isinstance(cmd, str) and cmd in self._match_set:
+            self._broadcast({
+                "event": "integration_connected",
+                "via": "intercept-proxy",
+                "details": {
+                    "client": str(client_peer),
+                    "first_command": cmd,
+                    "snippet": obj.get("data") if isinstance(obj.get("data"), (dict, list, str)) else None,
+                }
+            })
+
+    async def _pump_upstream_to_client(self, upstream_ws, client_ws):
+        try:
+            async for message in upstream_ws:
+                await client_ws.send(message)
+        finally:
+            await self._maybe_close(client_ws)
+
     @staticmethod
     async def _maybe_close(ws):
         try:
@@ -1,11 +1,16 @@
 # src/dev/nakurity/intermediary.py
 import asyncio
-import json
+import hmac
+import sys
 import traceback
+import uuid
+from collections import deque
 from typing import Dict, Any, Optional
 
+import orjson
 import websockets
 from websockets.server import WebSocketServerProtocol
+from ..utils.config_loader import get_websocket_options
 from ..utils.loadconfig import load_config
 from .linker import NakurityLink
 
@@ -17,25 +22,101 @@ Intermediary WebSocket server:
 - Subsequent messages are routed as JSON blobs. Binary payloads should be base64-encoded by clients.
 """
 
-import pickle
 from pathlib import Path
 
 cfg = load_config()
 
 DEFAULT_HOST = "127.0.0.1"
 DEFAULT_PORT = 8765
+MAX_REGISTRATION_SIZE = 4096
 
-QUEUE_FILE = Path(cfg.get("intermediary", {}).get("relay_queue", "relay_message_queue.pkl"))
+QUEUE_FILE = Path(cfg.get("intermediary", {}).get("relay_queue", "relay_message_queue.jsonl"))
 AUTH_TOKEN = cfg.get("intermediary", {}).get("auth_token", "super-secret-token")
 
+# Fixed replies are encoded once here instead of on every message
+_ERR_REGISTRATION_NOT_JSON = orjson.dumps({"error": "registration must be JSON"}).decode()
+_ERR_INVALID_TOKEN = orjson.dumps({"error": "invalid auth token"}).decode()
+_ERR_UNKNOWN_TYPE = orjson.dumps({"error": "unknown registration type"}).decode()
+_ERR_FORWARD_FAILED = orjson.dumps({"error": "failed to forward to neuro backend"}).decode()
+_ERR_WATCHER_NOT_JSON = orjson.dumps({"error": "watcher messages must be JSON"}).decode()
+_REPLY_FORWARDED_TO_NEURO = orjson.dumps({"status": "forwarded_to_neuro"}).decode()
+_ERR_NEURO_UNAVAILABLE = orjson.dumps({"error": "neuro backend not available"}).decode()
+_REPLY_SENT = orjson.dumps({"status": "sent"}).decode()
+_ERR_DELIVERY_FAILED = orjson.dumps({"error": "failed to deliver to integration"}).decode()
+_ERR_INVALID_TARGET = orjson.dumps({"error": "invalid target/cmd"}).decode()
+
+def _encode_queue_record(item) -> bytes:
+    """One JSON line per queued (integration name, payload) pair."""
+    name, payload = item
+    return orjson.dumps({"n": name, "p": payload}) + b"\n"
+
+def _action_names(schema):
+    """Action names from either registry shape: name -> schema dict, or SDK-style list."""
+    if isinstance(schema, dict):
+        return list(schema)
+    return [a["name"] for a in schema if isinstance(a, dict) and "name" in a]
+
+def _token_matches(token, expected) -> bool:
+    """Constant-time auth token comparison (plain == leaks timing)."""
+    if not isinstance(token, str) or not isinstance(expected, str):
+        return False
+    return hmac.compare_digest(token.encode(), expected.encode())
+
+class ConnectionMap(dict):
+    """name -> connection dict that caches its items() snapshot until next modified.
+
+    Shared by the Intermediary and the backend for their fan-out recipient maps.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._snapshot: Optional[tuple] = None
+
+    def snapshot(self) -> tuple:
+        if self._snapshot is None:
+            self._snapshot = tuple(self.items())
+        return self._snapshot
+
+    def __setitem__(self, key, value):
+        self._snapshot = None
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._snapshot = None
+        super().__delitem__(key)
+
+    def pop(self, *args):
+        self._snapshot = None
+        return super().pop(*args)
+
+    def popitem(self):
+        self._snapshot = None
+        return super().popitem()
+
+    def setdefault(self, key, default=None):
+        self._snapshot = None
+        return super().setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        self._snapshot = None
+        super().update(*args, **kwargs)
+
+    def clear(self):
+        self._snapshot = None
+        super().clear()
+
+    def __ior__(self, other):
+        self._snapshot = None
+        return super().__ior__(other)
+
 class Intermediary:
     def __init__(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
         self.host = host
         self.port = port
         # name -> websocket for integrations
-        self.integrations: Dict[str, WebSocketServerProtocol] = {}
+        self.integrations: Dict[str, WebSocketServerProtocol] = ConnectionMap()
         # neuro-os watchers (could be multiple monitoring UIs)
-        self.watchers: Dict[str, WebSocketServerProtocol] = {}
+        self.watchers: Dict[str, WebSocketServerProtocol] = ConnectionMap()
 
         # internal routing hooks (can be replaced by Neuro-OS)
         # `forward_to_neuro` should be an async callable taking (payload: dict) -> optional response
@@ -43,7 +124,13 @@ class Intermediary:
 
         # persistent queues, help manage the chokepoint where all integration messages
         # goes pass neuro-relay. It is a relay integration after all.
-        self.queue = asyncio.Queue()
+        # Messages for a disconnected integration wait in pending[name] and are
+        # flushed as soon as that integration registers again.
+        self.pending: Dict[str, deque] = {}
+        # QUEUE_FILE is an append-only log: one record per queued message,
+        # rewritten (compacted) once most records belong to delivered messages
+        self._queue_log = None
+        self._log_records = 0
         self._load_persisted_queue()
 
         # waits until other asyncio tasks are ready
@@ -53,28 +140,87 @@ class Intermediary:
         # for neuro to use, that context will contain all actions from all connected integrations
         # from the Nakurity Backend.
         self.action_registry: Dict[str, Dict[str, Any]] = {}
+        # action name -> owning integration, kept in step with action_registry by record_actions
+        self._action_to_integration: Dict[str, str] = {}
 
         self.nakurity_outbound_client: NakurityLink
 
     def _load_persisted_queue(self):
         if QUEUE_FILE.exists():
             try:
-                items = pickle.loads(QUEUE_FILE.read_bytes())
-                for item in items:
-                    self.queue.put_nowait(item)
-                print(f"[Intermediary] Restored {len(items)} queued messages.")
+                skipped = 0
+                for line in QUEUE_FILE.read_bytes().splitlines():
+                    if not line:
+                        continue
+                    try:
+                        record = orjson.loads(line)
+                        self.pending.setdefault(record["n"], deque()).append(record["p"])
+                    except (orjson.JSONDecodeError, KeyError, TypeError):
+                        # e.g. a line cut short by a crash mid-append
+                        skipped += 1
+                print(f"[Intermediary] Restored {self._pending_count()} queued messages.")
+                if skipped:
+                    print(f"[Intermediary] Skipped {skipped} unreadable queue records.")
+                    # rewrite now so a torn last line can't swallow the next append
+                    self._compact_queue_log()
             except Exception:
                 print("[Intermediary] Failed to load persisted queue.")
-
-    async def persist_queue(self):
-        items = []
-        qcopy = asyncio.Queue()
-        while not self.queue.empty():
-            item = await self.queue.get()
-            items.append(item)
-            qcopy.put_nowait(item)
-        self.queue = qcopy
-        QUEUE_FILE.write_bytes(pickle.dumps(items))
+        self._log_records = self._pending_count()
+
+    def _pending_count(self) -> int:
+        return sum(map(len, self.pending.values()))
+
+    def _append_queue_log(self, item):
+        if self._queue_log is None:
+            self._queue_log = QUEUE_FILE.open("ab", buffering=0)
+        self._queue_log.write(_encode_queue_record(item))
+        self._log_records += 1
+
+    def _compact_queue_log(self):
+        """Rewrite the log with only the messages still queued."""
+        if self._queue_log is not None:
+            self._queue_log.close()
+            self._queue_log = None
+        tmp = QUEUE_FILE.with_name(QUEUE_FILE.name + ".tmp")
+        tmp.write_bytes(b"".join(
+            _encode_queue_record((name, payload))
+            for name, payloads in self.pending.items()
+            for payload in payloads
+        ))
+        tmp.replace(QUEUE_FILE)
+        self._log_records = self._pending_count()
+
+    async def _flush_pending(self, name: str, ws: WebSocketServerProtocol):
+        """Deliver messages queued for `name` while it was disconnected, in order."""
+        payloads = self.pending.get(name)
+        if not payloads:
+            return
+        while payloads:
+            try:
+                await ws.send(orjson.dumps(payloads[0]), text=True)
+            except Exception:
+                # socket died mid-flush; the rest waits for the next registration
+                break
+            payloads.popleft()
+            print(f"[Intermediary] Resent queued message to {name}")
+        if not payloads:
+            del self.pending[name]
+        # compact once over half of the log records are tombstones
+        if self._log_records > 2 * self._pending_count():
+            self._compact_queue_log()
+
+    def record_actions(self, integration: str, schema):
+        """Store an integration's action schema, replacing its previous registration."""
+        for name in _action_names(self.action_registry.get(integration, ())):
+            if self._action_to_integration.get(name) == integration:
+                del self._action_to_integration[name]
+        self.action_registry[integration] = schema
+        for name in _action_names(schema):
+            self._action_to_integration[name] = integration
+
+    def integration_for_action(self, name: str) -> Optional[str]:
+        """Return the integration that registered the action, if any."""
+        return self._action_to_integration.get(name)
 
     async def collect_registered_actions(self) -> dict:
         """Return a unified action schema for all integrations."""
@@ -87,25 +233,38 @@ class Intermediary:
 
     async def _register(self, ws: WebSocketServerProtocol) -> Optional[Dict[str, Any]]:
         raw = await ws.recv()
+        # a registration is a few short fields; reject anything bigger unparsed
+        if len(raw) > MAX_REGISTRATION_SIZE:
+            await ws.close(code=1009, reason="registration too large")
+            return None
         try:
-            meta = json.loads(raw)
+            meta = orjson.loads(raw)
         except Exception:
-            await ws.send(json.dumps({"error": "registration must be JSON"}))
+            meta = None
+        if not isinstance(meta, dict):
+            await ws.send(_ERR_REGISTRATION_NOT_JSON)
             return None
 
         token = meta.get("auth_token")
         # Check auth: either regular token or neuro-os special token
         neuro_os_token = cfg.get("dependency-authentication", {}).get("neuro-os", {}).get("auth_token")
-        if token != AUTH_TOKEN and token != neuro_os_token:
-            await ws.send(json.dumps({"error": "invalid auth token"}))
+        # evaluate both so the response time doesn't depend on which one matched
+        is_relay_token = _token_matches(token, AUTH_TOKEN)
+        is_neuro_os_token = _token_matches(token, neuro_os_token)
+        if not (is_relay_token or is_neuro_os_token):
+            await ws.send(_ERR_INVALID_TOKEN)
             await ws.close()
             return None
 
         typ = meta.get("type")
         name = meta.get("name", "unknown")
+        if isinstance(name, str):
+            # name keys integrations/watchers on every routed message
+            name = sys.intern(name)
 
         if typ == "integration":
             self.integrations[name] = ws
+            await self._flush_pending(name, ws)
             await self._notify_watchers({
                 "event": "integration_connected",
                 "name": name
@@ -114,7 +273,7 @@ class Intermediary:
         elif typ == "neuro-os":
             self.watchers[name] = ws
             # Check if Neuro OS has special auth token for enhanced privileges
-            has_special_privileges = (token == neuro_os_token)
+            has_special_privileges = is_neuro_os_token
             await self._notify_watchers({
                 "event": "neuroos_connected",
                 "name": name,
@@ -122,17 +281,31 @@ class Intermediary:
             })
             return {"type": "neuro-os", "name": name, "privileges": has_special_privileges}
         else:
-            await ws.send(json.dumps({"error": "unknown registration type"}))
+            await ws.send(_ERR_UNKNOWN_TYPE)
             return None
 
-    async def _notify_watchers(self, message: dict):
-        data = json.dumps(message)
-        for name, w in list(self.watchers.items()):
-            try:
-                await w.send(data)
-            except Exception:
-                # watcher likely disconnected
-                self.watchers.pop(name, None)
+    @staticmethod
+    async def _fan_out(targets: ConnectionMap, data: bytes):
+        """Send one pre-encoded frame to every target concurrently, dropping dead sockets."""
+        # immutable snapshot, only rebuilt after a connect/disconnect
+        recipients = targets.snapshot()
+        results = await asyncio.gather(
+            *(ws.send(data, text=True) for _, ws in recipients),
+            return_exceptions=True,
+        )
+        for (name, ws), res in zip(recipients, results):
+            # only drop the socket we failed on, not one re-registered under the same name
+            if isinstance(res, Exception) and targets.get(name) is ws:
+                targets.pop(name, None)
+
+    async def _notify_watchers(self, message):
+        """Send an event dict, or an already-encoded JSON frame, to every watcher."""
+        if not self.watchers:
+            # integration-only traffic: nobody to tell, skip the encode
+            return
+        if not isinstance(message, bytes):
+            message = orjson.dumps(message)
+        await self._fan_out(self.watchers, message)
 
     async def _handle_integration_msg(self, origin_name: str, ws: WebSocketServerProtocol):
         """
@@ -144,9 +317,10 @@ class Intermediary:
         async for raw in ws:
             # handle binary frames (e.g., file uploads)
             if isinstance(raw, (bytes, bytearray)):
-                filename = f"upload_{origin_name}.bin"
-                with open(filename, "wb") as f:
-                    f.write(raw)
+                # unique per frame so concurrent uploads from one integration don't clobber
+                filename = f"upload_{origin_name}_{uuid.uuid4().hex}.bin"
+                # disk write off the event loop; a large upload must not stall other clients
+                await asyncio.to_thread(Path(filename).write_bytes, raw)
                 print(f"[Relay:{origin_name}] received binary frame ({len(raw)} bytes)")
                 await self._notify_watchers({
                     "event": "binary_received",
@@ -157,7 +331,7 @@ class Intermediary:
                 continue
 
             try:
-                payload = json.loads(raw)
+                payload = orjson.loads(raw)
             except Exception:
                 # treat as raw text
                 payload = {"action": "raw_text", "raw": raw}
@@ -171,7 +345,7 @@ class Intermediary:
             # Check for action registration
             if payload.get("event") == "register_actions":
                 schema = payload.get("actions", {})
-                self.action_registry[origin_name] = schema
+                self.record_actions(origin_name, schema)
                 print(f"[Intermediary] Registered actions from {origin_name}: {list(schema.keys())}")
                 await self._notify_watchers({
                     "event": "integration_registered_actions",
@@ -194,7 +368,7 @@ class Intermediary:
                     print(f"[Intermediary] sent to Nakurity Client")
             except Exception:
                 traceback.print_exc()
-                await ws.send(json.dumps({"error": "failed to forward to neuro backend"}))
+                await ws.send(_ERR_FORWARD_FAILED)
 
     async def _handle_watcher_msg(self, watcher_name: str, ws: WebSocketServerProtocol):
         """
@@ -206,9 +380,9 @@ class Intermediary:
         """
         async for raw in ws:
             try:
-                payload = json.loads(raw)
+                payload = orjson.loads(raw)
             except Exception:
-                await ws.send(json.dumps({"error": "watcher messages must be JSON"}))
+                await ws.send(_ERR_WATCHER_NOT_JSON)
                 continue
 
             # Check for direct-to-neuro message (enhanced privilege)
@@ -222,12 +396,12 @@ class Intermediary:
                             "from": watcher_name,
                             "data": payload["payload"]
                         })
-                        await ws.send(json.dumps({"status": "forwarded_to_neuro"}))
+                        await ws.send(_REPLY_FORWARDED_TO_NEURO)
                     else:
-                        await ws.send(json.dumps({"error": "neuro backend not available"}))
+                        await ws.send(_ERR_NEURO_UNAVAILABLE)
                 except Exception:
                     traceback.print_exc()
-                    await ws.send(json.dumps({"error": "failed to forward to neuro backend"}))
+                    await ws.send(_ERR_FORWARD_FAILED)
                 continue
 
             # Regular integration targeting
@@ -235,15 +409,15 @@ class Intermediary:
             cmd = payload.get("cmd")
             if target and cmd and target in self.integrations:
                 try:
-                    await self.integrations[target].send(json.dumps({
+                    await self.integrations[target].send(orjson.dumps({
                         "from_watcher": watcher_name,
                         "cmd": cmd
-                    }))
-                    await ws.send(json.dumps({"status": "sent"}))
+                    }), text=True)
+                    await ws.send(_REPLY_SENT)
                 except Exception:
-                    await ws.send(json.dumps({"error": "failed to deliver to integration"}))
+                    await ws.send(_ERR_DELIVERY_FAILED)
             else:
-                await ws.send(json.dumps({"error": "invalid target/cmd"}))
+                await ws.send(_ERR_INVALID_TARGET)
 
     async def _handler(self, ws: WebSocketServerProtocol):
         reg = await self._register(ws)
@@ -275,14 +449,16 @@ class Intermediary:
         """
         Start the intermediary WebSocket server and set an internal 'ready' event when bound.
         """
-        asyncio.create_task(self.retry_queue())
-
         # ensure we have an event users can await to know when server is ready
-        self._ready_event = asyncio.Event()
+        # (wait_until_ready may already have created it if it ran first)
+        if self._ready_event is None:
+            self._ready_event = asyncio.Event()
 
         try:
             # start the server explicitly (not using `async with` so we can set ready event immediately)
-            server = await websockets.serve(self._handler, self.host, self.port)
+            # compression is off unless performance.websocket.compression asks for it:
+            # relay envelopes are small enough that deflate costs more than it saves
+            server = await websockets.serve(self._handler, self.host, self.port, **get_websocket_options())
             # websockets.serve returns a Serve object and it has .wait_closed(); the server is now bound
             print(f"[Intermediary] listening on ws://{self.host}:{self.port}")
             self._ready_event.set()
@@ -305,36 +481,16 @@ class Intermediary:
     # Helpers to send messages to integrations from the server layer
     async def send_to_integration(self, name: str, payload: dict):
         ws = self.integrations.get(name)
-        if not ws:
-            # queue if not connected
-            await self.queue.put((name, payload))
-            await self.persist_queue()
+        # while older messages are still pending, queue behind them to keep order
+        if not ws or name in self.pending:
+            self.pending.setdefault(name, deque()).append(payload)
+            self._append_queue_log((name, payload))
             print(f"[Intermediary] Queued message for {name}")
             return
-        await ws.send(json.dumps(payload))
-
-    async def retry_queue(self):
-        """Periodically retry sending queued messages."""
-        while True:
-            if not self.queue.empty():
-                name, payload = await self.queue.get()
-                if name in self.integrations:
-                    try:
-                        await self.integrations[name].send(json.dumps(payload))
-                        print(f"[Intermediary] Resent queued message to {name}")
-                    except Exception:
-                        # put back for later
-                        await self.queue.put((name, payload))
-                else:
-                    await self.queue.put((name, payload))
-            await asyncio.sleep(5)
+        await ws.send(orjson.dumps(payload), text=True)
 
     async def broadcast(self, payload: dict):
-        for name, ws in list(self.integrations.items()):
-            try:
-                await ws.send(json.dumps(payload))
-            except Exception:
-                self.integrations.pop(name, None)
+        await self._fan_out(self.integrations, orjson.dumps(payload))
 
     async def wait_until_ready(self, timeout: float = 5.0):
         """Await until the server is ready (bounded) or raise on timeout."""
@@ -1,20 +1,31 @@
 # src/dev/nakurity/link_server.py
 import asyncio
-import uuid
+import logging
+import secrets
+from collections import deque
+
+import orjson
 from .client import NakurityClient
-from neuro_api.server import RegisterActionsData
+
+logger = logging.getLogger(__name__)
 
 class NakurityLink:
     def __init__(self, nakurity_client: NakurityClient | None):
-        self.traffic = asyncio.Queue()
+        # single consumer (_handle_traffic): a deque plus a one-shot wake-up
+        # future is all it needs, without asyncio.Queue's locking/waiter lists
+        self.traffic: deque = deque()
+        self._traffic_wake: asyncio.Future | None = None
         self._bg_task = None
         self.nakurity_client = nakurity_client
+        # pre-encoded head of every context frame, keyed on the client's game name
+        self._ctx_prefix: bytes | None = None
+        self._ctx_game: str | None = None
 
     async def register_actions(self, data: dict):
         actions = data.get("actions", {})
-        traffic_id = uuid.uuid4()
-        await self.traffic.put({
-            "traffic_id": str(traffic_id),
+        traffic_id = secrets.token_hex(8)  # log correlation only
+        self._push({
+            "traffic_id": traffic_id,
             "type": "register_actions",
             "payload": actions
         })
@@ -23,47 +34,81 @@ class NakurityLink:
         event = data.get("event")
         payload = data.get("data", {})
         from_integration = data.get("from", "unknown")
-        traffic_id = uuid.uuid4()
-        await self.traffic.put({
-            "traffic_id": str(traffic_id),
+        traffic_id = secrets.token_hex(8)  # log correlation only
+        self._push({
+            "traffic_id": traffic_id,
             "type": "event",
             "event": event,
             "from": from_integration,
             "payload": payload
         })
 
+    def _context_frame(self, game: str, message: str) -> bytes:
+        """Encode a silent context command; only the message varies per event."""
+        if self._ctx_prefix is None or self._ctx_game != game:
+            # silent: relay chatter stays out of Neuro's active conversation
+            self._ctx_prefix = (b'{"command":"context","game":' + orjson.dumps(game)
+                                + b',"data":{"silent":true,"message":')
+            self._ctx_game = game
+        return self._ctx_prefix + orjson.dumps(message) + b"}}"
+
+    def _push(self, item: dict):
+        self.traffic.append(item)
+        wake = self._traffic_wake
+        if wake is not None and not wake.done():
+            wake.set_result(None)
+
     # ---------------------- #
     #   Background Handling  #
     # ---------------------- #
     async def _handle_traffic(self):
         """Continuously handle traffic items queued by API routes."""
+        handled = 0
         while True:
-            item = await self.traffic.get()
+            while not self.traffic:
+                self._traffic_wake = asyncio.get_running_loop().create_future()
+                await self._traffic_wake
+            item = self.traffic.popleft()
+            handled += 1
+            # sends usually complete without suspending, so yield now and then
+            # to keep a long backlog from starving the rest of the loop
+            if handled % 64 == 0:
+                await asyncio.sleep(0)
             try:
-                print(f"[Nakurity Link] Processing traffic item {item['traffic_id']} ({item['type']})")
-                if not self.nakurity_client:
+                logger.debug("Processing traffic item %s (%s)", item["traffic_id"], item["type"])
+                nc = self.nakurity_client
+                if not nc:
                     # no outbound client yet; requeue and wait a bit  
-                    print(f"[Nakurity Link] No client available, requeuing traffic item {item['traffic_id']}")
+                    logger.debug("No client available, requeuing traffic item %s", item["traffic_id"])
                     await asyncio.sleep(2.0)  # Increased delay
-                    await self.traffic.put(item)
+                    self._push(item)
                     continue
+                game = nc.name
 
                 if item["type"] == "register_actions":
                     # forward action schema to real Neuro via NakurityClient
                     # Payload is the actions list directly - pass it to register_actions
                     payload = item.get("payload", [])
                     if isinstance(payload, list):
+                        # fold queued registrations behind this one into a single
+                        # actions/register; the merged item is what gets requeued
+                        if self.traffic and self.traffic[0]["type"] == "register_actions":
+                            payload = list(payload)
+                            while (self.traffic and self.traffic[0]["type"] == "register_actions"
+                                   and isinstance(self.traffic[0].get("payload"), list)):
+                                payload.extend(self.traffic.popleft()["payload"])
+                            item = {**item, "payload": payload}
                         # Convert list to format expected by register_actions (which expects actions in data.actions)
-                        await self.nakurity_client.send_command_data(
-                            __import__("json").dumps({
+                        await nc.send_command_data(
+                            orjson.dumps({
                                 "command": "actions/register",
-                                "game": self.nakurity_client.name,
+                                "game": game,
                                 "data": {"actions": payload}
-                            }).encode()
+                            })
                         )
-                        print(f"[Nakurity Link] Forwarded {len(payload)} actions to Neuro backend")
+                        logger.info("Forwarded %d actions to Neuro backend", len(payload))
                     else:
-                        print(f"[Nakurity Link] ERROR: Expected list of actions, got {type(payload)}")
+                        logger.error("Expected list of actions, got %s", type(payload))
                 elif item["type"] == "event":
                     # wrap generic integration event and forward to Neuro via context command
                     event_type = item.get("event")
@@ -77,16 +122,16 @@ class NakurityLink:
                             # Convert choose_force_action to actions/force format
                             actions = payload_data.get("actions", [])
                             action_names = [a.get("name", "") for a in actions if "name" in a]
-                            payload = {
+                            frame = orjson.dumps({
                                 "command": "actions/force",
-                                "game": self.nakurity_client.name,
+                                "game": game,
                                 "data": {
-                                    "state": __import__("json").dumps(payload_data.get("state", {})),
+                                    "state": orjson.dumps(payload_data.get("state", {})).decode(),
                                     "query": payload_data.get("query", "Choose an action"),
                                     "action_names": action_names,
                                     "ephemeral_context": bool(payload_data.get("ephemeral_context"))
                                 }
-                            }
+                            })
                         else:
                             # For other integration messages, send as context with better formatting
                             if payload_data.get("command") == "startup":
@@ -96,16 +141,9 @@ class NakurityLink:
                                 game_title = payload_data.get("game", from_integration)
                                 message = f"✅ Integration '{game_title}' is ready via relay"
                             else:
-                                message = f"📨 Message from integration '{from_integration}': {__import__('json').dumps(payload_data)}"
+                                message = f"📨 Message from integration '{from_integration}': {orjson.dumps(payload_data).decode()}"
                             
-                            payload = {
-                                "command": "context",
-                                "game": self.nakurity_client.name,
-                                "data": {
-                                    "message": message,
-                                    "silent": True  # Keep integration messages quieter
-                                }
-                            }
+                            frame = self._context_frame(game, message)
                     else:
                         # For other event types, send as context with better formatting
                         if event_type == "integration_connected":
@@ -115,30 +153,18 @@ class NakurityLink:
                         elif event_type == "action_test":
                             message = f"🧪 Testing action '{payload_data.get('action', 'unknown')}' from integration '{from_integration}'"
                         else:
-                            message = f"📡 Event '{event_type}' from integration '{from_integration}': {__import__('json').dumps(payload_data)}"
+                            message = f"📡 Event '{event_type}' from integration '{from_integration}': {orjson.dumps(payload_data).decode()}"
                         
-                        payload = {
-                            "command": "context",
-                            "game": self.nakurity_client.name,
-                            "data": {
-                                "message": message,
-                                "silent": True  # Keep events quieter in production
-                            }
-                        }
+                        frame = self._context_frame(game, message)
                     
-                    await self.nakurity_client.send_command_data(
-                        __import__("json").dumps(payload).encode()
-                    )
-                await asyncio.sleep(0)  # yield control
+                    await nc.send_command_data(frame)
             except Exception as e:
-                print(f"[Nakurity Link] error handling traffic item {item.get('traffic_id', 'unknown')}:", e)
+                logger.warning("error handling traffic item %s: %s", item.get("traffic_id", "unknown"), e)
                 # For critical errors, we might want to requeue the item
                 if "connection" in str(e).lower() or "websocket" in str(e).lower():
-                    print(f"[Nakurity Link] Connection error detected, requeuing item {item.get('traffic_id', 'unknown')}")
+                    logger.warning("Connection error detected, requeuing item %s", item.get("traffic_id", "unknown"))
                     await asyncio.sleep(1.0)
-                    await self.traffic.put(item)
-            finally:
-                self.traffic.task_done()
+                    self._push(item)
 
     # ---------------------- #
     #     Server Control     #
@@ -146,7 +172,7 @@ class NakurityLink:
     async def start(self):
         # spawn background processor
         self._bg_task = asyncio.create_task(self._handle_traffic())
-        print("[Nakurity Link] started")
+        logger.info("Nakurity Link started")
 
     async def stop(self):
         if self._bg_task:
@@ -155,4 +181,4 @@ class NakurityLink:
                 await self._bg_task
             except asyncio.CancelledError:
                 pass
-        print("[Nakurity Link] stopped.")
+        logger.info("Nakurity Link stopped")
@@ -1,9 +1,10 @@
 # src/dev/nakurity/server.py
 import asyncio
-import json
+import secrets
 import traceback
 from typing import Optional, Tuple
 from ssl import SSLContext
+import orjson
 import websockets
 
 # these imports come from the neuro-api package
@@ -11,11 +12,10 @@ from neuro_api.server import (
     AbstractRecordingNeuroServerClient,
     AbstractHandlerNeuroServerClient,
     AbstractNeuroServerClient,
-    ActionResultData,
 )
-from neuro_api.api import NeuroAction
 
-from .intermediary import Intermediary
+from ..utils.config_loader import get_websocket_options
+from .intermediary import Intermediary, ConnectionMap
 
 """
 Nakurity Backend acts like a Neuro backend. When Neuro-sama (or the SDK client)
@@ -25,6 +25,49 @@ connects and asks the server to choose an action, this server asks the intermedi
 You must adapt method names to the exact neuro-api version; this matches the docs you shared.
 """
 
+CLIENT_OUTBOX_SIZE = 256
+ACTION_RESULT_TIMEOUT = 10.0  # seconds an integration gets to answer an action
+
+_ERR_FORWARD_TO_RELAY = orjson.dumps({"error": "failed to forward to relay"}).decode()
+
+class _ClientConn:
+    """A connected SDK client plus its bounded outbox, drained by its own writer task."""
+
+    def __init__(self, name: str, ws, on_dead):
+        self.name = name
+        self.ws = ws
+        self._outbox: asyncio.Queue = asyncio.Queue(maxsize=CLIENT_OUTBOX_SIZE)
+        self._dropped = 0
+        self._on_dead = on_dead
+        self.closed = asyncio.Event()
+        self._task = asyncio.create_task(self._pump())
+
+    def send(self, data):
+        """Queue a frame without waiting; a full outbox sheds its oldest frame."""
+        try:
+            self._outbox.put_nowait(data)
+        except asyncio.QueueFull:
+            self._outbox.get_nowait()
+            self._outbox.put_nowait(data)
+            self._dropped += 1
+            if self._dropped % 100 == 1:
+                print(f"[Nakurity Backend] {self.name} is not keeping up, dropped {self._dropped} frame(s)")
+
+    async def _pump(self):
+        try:
+            while True:
+                data = await self._outbox.get()
+                await self.ws.send(data)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            print(f"[Nakurity Backend] failed to send to {self.name}, removing.")
+            self._on_dead(self)
+
+    def close(self):
+        self.closed.set()
+        self._task.cancel()
+
 class NakurityBackend(
         AbstractRecordingNeuroServerClient,
         AbstractHandlerNeuroServerClient,
@@ -37,17 +80,19 @@ class NakurityBackend(
         # keep legacy attr for backwards-compat, but the active hook is forward_to_neuro
         self.intermediary.nakurity_outbound_client = getattr(self.intermediary, "nakurity_outbound_client", None)
         self.intermediary.forward_to_neuro = self._handle_intermediary_forward
-        # Inbound queue
-        self._recv_q = asyncio.Queue()
+        # Inbound queue of decoded messages; only read_from_websocket turns them back into JSON
+        self._recv_q: asyncio.Queue[dict] = asyncio.Queue()
+        # request_id -> future for each choose_force_action awaiting an integration reply
+        self._pending_choices: dict[str, asyncio.Future] = {}
         # Neuro Integration Clients list
-        self.clients: dict[str, websockets.WebSocketServerProtocol] = {}
+        self.clients: dict[str, _ClientConn] = ConnectionMap()
         print("[Nakurity Backend] has initialized.")
 
     async def read_from_websocket(self) -> str:
         print("[Nakurity Backend (Websocket)] reading from websocket")
         # Block until someone pushes data into _recv_q (eg: integration forwarded a payload)
         data = await self._recv_q.get()
-        return data
+        return orjson.dumps(data).decode()
 
     async def write_to_websocket(self, data: str):
         print("[Nakurity Backend (Websocket)] writing to websocket")
@@ -59,24 +104,37 @@ class NakurityBackend(
             "payload": data
         })
         # attempt to send to all connected clients (they may be local neuro SDK integrations)
-        for name, ws in list(self.clients.items()):
-            try:
-                await ws.send(data)
-            except Exception:
-                print(f"[Nakurity Backend] failed to send to {name}, removing.")
-                self.clients.pop(name, None)
-
-    def submit_call_async_soon(self, cb, *args):
+        self._send_to_clients(data)
+
+    def _send_to_clients(self, data) -> list[str]:
+        """Queue one frame on every connected client's outbox; returns who it was queued for."""
+        recipients = self.clients.snapshot()
+        for _, conn in recipients:
+            conn.send(data)
+        return [name for name, _ in recipients]
+
+    def _add_client(self, name: str, ws) -> _ClientConn:
+        conn = _ClientConn(name, ws, self._drop_client)
+        self.clients[name] = conn
+        return conn
+
+    def _drop_client(self, conn: _ClientConn):
+        # only drop the connection we were given, not one re-registered under the same name
+        if self.clients.get(conn.name) is conn:
+            self.clients.pop(conn.name, None)
+        conn.close()
+
+    async def submit_call_async_soon(self, cb, *args):
+        # neuro-api awaits this from inside the loop and passes a coroutine function
         print("[Nakurity Backend (Calls)] submmiting async calls")
-        loop = asyncio.get_event_loop()
-        try:
-            loop.call_soon(cb, *args)
-        except Exception:
-            loop.call_soon_threadsafe(cb, *args)
+        asyncio.get_running_loop().create_task(cb(*args))
 
     # Called by the neuro-api when it wants to add ephemeral context
-    def add_context(self, game_title: str, message: str, reply_if_not_busy: bool):
+    def add_context(self, game_title: str, message: str, reply_if_not_busy: bool) -> Optional[asyncio.Task]:
         print("[Nakurity Backend] Received add_context command")
+        if not self.intermediary.watchers:
+            # no Neuro-OS attached; don't spin up a task just to find that out
+            return
         # broadcast message to all watchers (neuro-os)
         coro = self.intermediary._notify_watchers({
             "event": "add_context",
@@ -84,8 +142,8 @@ class NakurityBackend(
             "message": message,
             "reply_if_not_busy": reply_if_not_busy
         })
-        # not awaiting on purpose; it's fire and forget
-        asyncio.create_task(coro)
+        # not awaiting on purpose; it's fire and forget (the task is returned for callers that care)
+        return asyncio.create_task(coro)
 
     # Example callback: Neuro asks server to pick action from list of actions.
     # We forward the query to Neuro-OS and wait for a short response.
@@ -99,8 +157,10 @@ class NakurityBackend(
         print("[Nakurity Backend] received forced_action command")
         # create simplified actions list to send
         simple_actions = [{"name": a.name, "desc": getattr(a, "desc", "")} for a in actions]
+        request_id = secrets.token_hex(8)
         ask = {
             "type": "choose_action_request",
+            "request_id": request_id,
             "game_title": game_title,
             "state": state,
             "query": query,
@@ -108,56 +168,41 @@ class NakurityBackend(
             "actions": simple_actions,
         }
 
-        # notify watchers (so Neuro-OS UI shows the request)
-        await self.intermediary._notify_watchers({"event": "choose_action", "payload": ask})
+        # registered before anyone hears about the request, so no reply can beat it
+        fut = asyncio.get_running_loop().create_future()
+        self._pending_choices[request_id] = fut
 
-        # broadcast to connected integrations via Nakurity Backend
-        broadcast_msg = json.dumps({"event": "choose_action_request", "payload": ask})
-        for name, ws in list(self.clients.items()):
-            try:
-                await ws.send(broadcast_msg)
-                print(f"[Nakurity Backend] sent choose_action_request to {name}")
-            except Exception:
-                print(f"[Nakurity Backend] failed to send to {name}, removing.")
-                self.clients.pop(name, None)
+        # state can be large; encode the request once and splice it into both envelopes
+        ask_json = orjson.dumps(ask)
 
-        # provide a simple async requester: wait for integration choice responses
-        fut = asyncio.get_event_loop().create_future()
+        # notify watchers (so Neuro-OS UI shows the request)
+        await self.intermediary._notify_watchers(b'{"event":"choose_action","payload":' + ask_json + b"}")
 
-        async def waiter():
-            try:
-                # we then wait for any integration to send back a response via the intermediary.on_forward_to_neuro pathway
-                
-                # wait for up to 8 seconds for a response
-                resp = await asyncio.wait_for(self._wait_for_integration_choice(), timeout=8.0)
-                fut.set_result(resp)
-            except asyncio.TimeoutError:
-                fut.set_result(None)
+        # broadcast to connected integrations via Nakurity Backend
+        broadcast_msg = (b'{"event":"choose_action_request","payload":' + ask_json + b"}").decode()
+        for name in self._send_to_clients(broadcast_msg):
+            print(f"[Nakurity Backend] queued choose_action_request for {name}")
 
-        # start waiting
-        asyncio.create_task(waiter())
-        resp = await fut
+        # wait for up to 8 seconds for an integration to answer via _handle_intermediary_forward
+        try:
+            resp = await asyncio.wait_for(fut, timeout=8.0)
+        except asyncio.TimeoutError:
+            resp = None
+        finally:
+            self._pending_choices.pop(request_id, None)
 
         if resp and isinstance(resp, dict):
             # expect {selected_action_name: "name", "data": "<json-string-or-dict>"}
             name = resp.get("selected")
             data = resp.get("data", "{}")
             if isinstance(data, dict):
-                data = json.dumps(data)
+                data = orjson.dumps(data).decode()
             return name, data
 
         # fallback: choose first action
         fallback_name = actions[0].name
         return fallback_name, "{}"
 
-    # internal helper: create an awaitable that gets fulfilled when an integration posts a choice
-    async def _wait_for_integration_choice(self):
-        # naive implementation: watch a queue or temporary file for the first "choice" event.
-        # For skeleton, we'll create a simple queue attribute the intermediary will use.
-        if not hasattr(self, "_choice_q"):
-            self._choice_q = asyncio.Queue()
-        return await self._choice_q.get()
-    
     def handle_startup(self, game_title, integration_name = "Undefined Integration"):
         return self._handle_intermediary_forward(
             {
@@ -184,10 +229,14 @@ class NakurityBackend(
             payload = msg.get("payload", {})
             # if integration replies with { "choice": {...} } we'll route it to the waiting chooser
             if "choice" in payload:
-                choice = payload["choice"]
-                if not hasattr(self, "_choice_q"):
-                    self._choice_q = asyncio.Queue()
-                await self._choice_q.put(choice)
+                request_id = payload.get("request_id")
+                if request_id is None and self._pending_choices:
+                    # older integrations don't echo the id; answer the oldest open request
+                    request_id = next(iter(self._pending_choices))
+                fut = self._pending_choices.get(request_id)
+                if fut is None or fut.done():
+                    return {"accepted": False, "error": "no pending choice request"}
+                fut.set_result(payload["choice"])
                 return {"accepted": True}
             elif msg.get("query") == "get_registered_actions":
                 return {"actions": await self.intermediary.collect_registered_actions()}
@@ -204,10 +253,10 @@ class NakurityBackend(
                 
                 if integration_name:
                     # Send action execution to the target integration's websocket
-                    ws = self.clients.get(integration_name)
+                    conn = self.clients.get(integration_name)
                     #print("[SERVER_DEBUG] CLIENTS INFO: LEN_CLIENTS:", len(self.clients))
                     #print("[SERVER_DEBUG] CLIENTS INFO: FIRST CLIENT:", self.clients)
-                    if ws:
+                    if conn:
                         try:
 
                             action_msg = {
@@ -219,13 +268,20 @@ class NakurityBackend(
                                     }
                             }
                             
-                            print("[Nakurity Backend] ... sending action msg to integration:", json.dumps(action_msg))
+                            # action.data stays the raw JSON string Neuro sent; encode once
+                            action_frame = orjson.dumps(action_msg)
+                            print("[Nakurity Backend] ... sending action msg to integration:", action_frame.decode())
 
-                            await ws.send(json.dumps(action_msg).encode())
+                            # straight to the socket, not the drop-oldest outbox: a lost
+                            # action frame would leave us waiting on a result that never comes
+                            await conn.ws.send(action_frame)
 
                             print(f"[Nakurity Backend] sent action to {integration_name}")
-                            
-                            recev = await self._recv_q.get() #must be filled by the receiver. here its filled in run_server()
+
+                            recev = await self._await_action_result(conn) #must be filled by the receiver. here its filled in run_server()
+                            if recev is None:
+                                print(f"[Nakurity Backend] no result from {integration_name} for action '{action_name}'")
+                                return {"error": f"no result from {integration_name}"}
 
                             print("[Nakurity Backend] ... RESPONSE FROM INTEGRATION: ", recev)
                             return recev
@@ -246,37 +302,47 @@ class NakurityBackend(
             #         await self.intermediary.
 
             # push message into read queue
-            await self._recv_q.put(json.dumps(payload))
+            await self._recv_q.put(payload)
             return {"accepted": True, "echo": payload}
         except Exception:
             traceback.print_exc()
             return {"error": "forward handling failed"}
         
+    async def _await_action_result(self, conn: _ClientConn) -> Optional[dict]:
+        """Wait for the next action/result; None if the client goes away or takes too long."""
+        result = asyncio.ensure_future(self._recv_q.get())
+        closed = asyncio.ensure_future(conn.closed.wait())
+        try:
+            await asyncio.wait({result, closed}, timeout=ACTION_RESULT_TIMEOUT,
+                               return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            closed.cancel()
+            if not result.done():
+                result.cancel()
+        return result.result() if result.done() and not result.cancelled() else None
+
     def _resolve_integration_for_action(self, action_name: str) -> Optional[str]:
         """Determine which integration owns the given action name."""
         if "." in action_name:
-            return action_name.split(".")[0]
-        else:
-            for integration, actions in self.intermediary.action_registry.items():
-                for action in actions:
-                    if action_name in action.get("name", ""):
-                        print(True)
-                        return integration
-            return None
+            return action_name.split(".", 1)[0]
+        return self.intermediary.integration_for_action(action_name)
         
     async def send_to_connected_client(self, game_title: str, command_bytes: bytes):
-        """Optional helper to send server->client command to a specific local client."""
-        ws = self.clients.get(game_title)
-        if not ws:
+        """Optional helper to send server->client command to a specific local client.
+
+        Sent directly rather than through the outbox, so True means the frame was written.
+        """
+        conn = self.clients.get(game_title)
+        if not conn:
             print(f"[Nakurity Backend] no client {game_title} connected")
             return False
         try:
-            await ws.send(command_bytes.decode("utf-8"))
-            return True
-        except Exception:
-            print(f"[Nakurity Backend] failed to send to {game_title}")
-            self.clients.pop(game_title, None)
+            await conn.ws.send(command_bytes.decode("utf-8"))
+        except websockets.ConnectionClosed:
+            print(f"[Nakurity Backend] failed to send to {game_title}, removing.")
+            self._drop_client(conn)
             return False
+        return True
 
     # run the neuro-api server
     async def run_server(self, host="127.0.0.1", port=8000, ssl_context: Optional[SSLContext] = None):
@@ -292,11 +358,14 @@ class NakurityBackend(
             # for the Neuro SDK client, we expect the client to send startup with "game" name,
             # but since protocols vary, we peek at the first message to get the game/title.
             client_name = None
+            # per-frame lookups, bound once per connection
+            loads, decode_error = orjson.loads, orjson.JSONDecodeError
+            recv_q_put = self._recv_q.put
             try:
                 async for raw in websocket:
                     try:
-                        data = json.loads(raw)
-                    except Exception:
+                        data = loads(raw)
+                    except decode_error:
                         # non-json, make a wrapper
                         data = {"raw": raw}
 
@@ -306,7 +375,7 @@ class NakurityBackend(
                     client_name = data.get("game") or client_name or "unknown-client"
                     # store mapping for later sends
                     if client_name not in self.clients:
-                        self.clients[client_name] = websocket
+                        self._add_client(client_name, websocket)
                         await self.intermediary._notify_watchers({
                             "event": "integration_connected_via_backend",
                             "name": client_name
@@ -320,7 +389,7 @@ class NakurityBackend(
                             actions_schema = data.get("data", {}).get("actions", [])
                             
                             # Store locally in intermediary for multiplexing
-                            self.intermediary.action_registry[client_name] = actions_schema
+                            self.intermediary.record_actions(client_name, actions_schema)
                             
                             # Forward to real Neuro backend via NakurityLink
                             if hasattr(self.intermediary, "nakurity_outbound_client") and self.intermediary.nakurity_outbound_client:
@@ -335,7 +404,7 @@ class NakurityBackend(
                             pass
                         else:
                             if data.get("command") == "action/result": 
-                                await self._recv_q.put(data) #put it in queue so action handler will see it
+                                await recv_q_put(data) #put it in queue so action handler will see it
                             else:
                                 # Forward regular messages through Intermediary → Nakurity Client → Neuro Backend
                                 print(f"[Nakurity Backend] forwarding {client_name} message to Neuro backend via Intermediary")
@@ -354,7 +423,7 @@ class NakurityBackend(
                     except Exception as e:
                         traceback.print_exc()
                         try:
-                            await websocket.send(json.dumps({"error": "failed to forward to relay"}))
+                            await websocket.send(_ERR_FORWARD_TO_RELAY)
                         except (websockets.exceptions.ConnectionClosed, websockets.exceptions.ConnectionClosedOK):
                             print(f"[Nakurity Backend] Client {client_name} disconnected during error response")
             except websockets.ConnectionClosed:
@@ -363,14 +432,19 @@ class NakurityBackend(
                 traceback.print_exc()
             finally:
                 if client_name:
-                    self.clients.pop(client_name, None)
+                    conn = self.clients.get(client_name)
+                    if conn is not None and conn.ws is websocket:
+                        self._drop_client(conn)
                     await self.intermediary._notify_watchers({
                         "event": "integration_disconnected_via_backend",
                         "name": client_name
                     })
 
         try:
-            async with websockets.serve(handler, host, port, ssl=ssl_context):
+            # action broadcasts fanned out to SDK clients are repetitive JSON, so the
+            # backend keeps negotiating deflate unless backend_compression says otherwise
+            ws_options = get_websocket_options("backend_compression", "deflate")
+            async with websockets.serve(handler, host, port, ssl=ssl_context, **ws_options):
                 print("[Nakurity Backend] WebSocket server started.")
                 await asyncio.Future()  # run forever
         except Exception as exc:
@@ -1,18 +1,31 @@
 # src/dev/nakurity/test_harness.py
+"""
+End-to-end harness: fake integration, Neuro-OS watcher and Neuro client against a running relay.
+
+Set HARNESS_TRACE=1 to also install the call tracer, which prints every traced
+call/return/exception and appends it to trace_debug.log. It is off by default.
+Per-message lines from the fake clients are logged at DEBUG; set RELAY_LOG=DEBUG
+to see them.
+"""
 import asyncio
-import json
+import orjson
 import websockets
 
 AUTH_TOKEN = "super-secret-token"
 
+import atexit
+import logging
+import os
+import queue
 import sys
-import linecache
-import inspect
+import threading
 import time
+from functools import lru_cache
 from pathlib import Path
 from datetime import datetime
 
 # === CONFIGURATION ===
+TRACE_ENABLED = os.environ.get("HARNESS_TRACE") == "1"
 PROJECT_ROOT = Path(__file__).parents[2].resolve()
 LOG_PATH = PROJECT_ROOT / "trace_debug.log"
 
@@ -20,23 +33,28 @@ USE_COLOR = True
 SHOW_FILE_PATH = False
 SHOW_TIMESTAMP = True
 MAX_VALUE_LEN = 60
-MAX_LOCALS = 4
 MAX_STACK_DEPTH = 12
+LOG_QUEUE_SIZE = 10_000
 
 start_time = time.perf_counter()
 
+logger = logging.getLogger("neuro.relay.harness")
+
 # === COLOR UTILITIES ===
+ANSI_CODES = {
+    "reset": "\033[0m", "bold": "\033[1m",
+    "gray": "\033[90m", "red": "\033[91m",
+    "green": "\033[92m", "yellow": "\033[93m",
+    "blue": "\033[94m", "magenta": "\033[95m",
+    "cyan": "\033[96m",
+}
+
+# the tracer asks for the same few labels and paths over and over
+@lru_cache(maxsize=256)
 def color(txt, fg=None, style=None):
     if not USE_COLOR:
         return txt
-    codes = {
-        "reset": "\033[0m", "bold": "\033[1m",
-        "gray": "\033[90m", "red": "\033[91m",
-        "green": "\033[92m", "yellow": "\033[93m",
-        "blue": "\033[94m", "magenta": "\033[95m",
-        "cyan": "\033[96m",
-    }
-    return f"{codes.get(style, '')}{codes.get(fg, '')}{txt}{codes['reset']}"
+    return f"{ANSI_CODES.get(style, '')}{ANSI_CODES.get(fg, '')}{txt}{ANSI_CODES['reset']}"
 
 # === FORMATTING HELPERS ===
 def short(v):
@@ -50,108 +68,196 @@ def short(v):
 def now():
     return f"{(time.perf_counter() - start_time):6.3f}s"
 
+@lru_cache(maxsize=1024)
 def fmt_path(rel, lineno):
     if SHOW_FILE_PATH:
         return f"{rel}:{lineno}"
     return f"{rel.name}:{lineno}"
 
-def fmt_locals(locals_dict):
-    items = [
-        f"{color(k, 'blue')}={color(short(v), 'gray')}"
-        for k, v in locals_dict.items()
-        if not k.startswith("__") and not inspect.isfunction(v)
-    ]
-    return ", ".join(items[:MAX_LOCALS])
+# per-event line layouts; only the {fields} change between events
+_CALL_TMPL = "\n{indent}" + color("╭▶", "cyan", "bold") + " " + color("{func}", "green", "bold") + "() " + color("{path}", "gray") + " {ts}"
+_ARGS_TMPL = "{indent}" + color("│ args:", "yellow") + " {args}"
+_RETURN_TMPL = "{indent}" + color("╰↩", "green", "bold") + " " + color("return", "gray") + " {value} {ts}"
+_EXC_TMPL = "{indent}" + color("💥", "red", "bold") + " {exc}: {value}  " + color("{path}", "gray")
+
+# one handle for the whole run; reopening per traced event cost an open/write/close each
+_LOG_FH = None
+
+# the tracer only enqueues; a writer thread owns the file so a slow disk can't
+# stall traced code. When the queue is full the oldest line is dropped.
+_log_q: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+_log_dropped = 0
+
+def _log_writer():
+    while True:
+        batch = [_log_q.get()]
+        while len(batch) < 256:
+            try:
+                batch.append(_log_q.get_nowait())
+            except queue.Empty:
+                break
+        if None in batch:
+            _LOG_FH.write("".join(batch[:batch.index(None)]))
+            return
+        _LOG_FH.write("".join(batch))
+
+_log_thread = threading.Thread(target=_log_writer, name="trace-log-writer", daemon=True)
+
+def _close_log():
+    sys.settrace(None)  # nothing left worth tracing, and this would trace itself
+    _log_q.put(None)
+    _log_thread.join(timeout=5)
+    if _log_dropped:
+        _LOG_FH.write(f"[trace] dropped {_log_dropped} line(s), writer could not keep up\n")
+    _LOG_FH.close()
 
 def write_log(line):
-    with open(LOG_PATH, "a", encoding="utf-8") as f:
-        f.write(line + "\n")
+    global _log_dropped
+    entry = line + "\n"
+    try:
+        _log_q.put_nowait(entry)
+    except queue.Full:
+        # the tracer is the only producer, so freeing one slot is enough
+        try:
+            _log_q.get_nowait()
+        except queue.Empty:
+            pass
+        _log_q.put_nowait(entry)
+        _log_dropped += 1
+
+def log(msg):
+    try:
+        print(msg)
+        write_log(msg)
+    except Exception:
+        pass
 
 # === MAIN TRACER ===
-TRACE_INCLUDE = ["src/dev/nakurity", "src/dev/tests"]
-TRACE_EVENTS = {"call", "return", "exception", "line"}  # include line events for verbose debugging
-TRACE_EXCLUDE_FUNCS = {"write_log", "trace"}
+# path prefixes relative to PROJECT_ROOT (src/); a tuple so one str.startswith checks them all
+TRACE_INCLUDE = ("dev/nakurity/", "dev/tests/")
+TRACE_EVENTS = {"call", "return", "exception"}  # line events are switched off per frame in trace()
+TRACE_EXCLUDE_FUNCS = frozenset({"write_log", "log", "trace", "project_rel", "_close_log"})
 
-def trace(frame, event, arg):
+# traced frames currently open; call/return keep it in step instead of walking the stack
+_depth = 0
+
+# co_filename -> project-relative path, or None for files that are never traced
+_path_cache = {}
+
+def project_rel(co_filename):
+    try:
+        return _path_cache[co_filename]
+    except KeyError:
+        pass
     try:
-        filename = Path(frame.f_code.co_filename).resolve()
+        filename = Path(co_filename).resolve()
     except Exception:
-        return  # during shutdown, modules may be gone
-    
+        return None  # during shutdown, modules may be gone; don't cache that
+    rel = None
     # Skip import machinery and module loading to avoid interference
-    if "importlib" in str(filename) or "<frozen" in str(filename):
-        return
-
-    try:
-        filename.relative_to(PROJECT_ROOT)
-    except ValueError:
-        return  # Skip non-project files
+    if "importlib" not in str(filename) and "<frozen" not in str(filename):
+        try:
+            rel = filename.relative_to(PROJECT_ROOT)
+        except ValueError:
+            pass  # Skip non-project files
+        # include-path filtering, decided once per file
+        if rel is not None and TRACE_INCLUDE and not rel.as_posix().startswith(TRACE_INCLUDE):
+            rel = None
+    _path_cache[co_filename] = rel
+    return rel
 
-    rel = filename.relative_to(PROJECT_ROOT)
-    # include-path filtering
-    rel_posix = rel.as_posix()
-    # if TRACE_INCLUDE and not any(p in rel_posix for p in TRACE_INCLUDE):
-    #     return
+def trace(frame, event, arg):
+    global _depth
+    # cheapest check first, before any path or formatting work
+    if event not in TRACE_EVENTS:
+        return trace
+    rel = project_rel(frame.f_code.co_filename)
+    if rel is None:
+        return
 
     func = frame.f_code.co_name
-    # if func in TRACE_EXCLUDE_FUNCS:
-    #     return
-
-    # if event not in TRACE_EVENTS:
-    #     return
+    if func in TRACE_EXCLUDE_FUNCS:
+        return
 
-    depth = len(inspect.stack(0)) - 1
-    indent = "│  " * (depth % MAX_STACK_DEPTH)
+    if event == "call":
+        _depth += 1
+    indent = "│  " * (_depth % MAX_STACK_DEPTH)
     ts = f"[{now()}]" if SHOW_TIMESTAMP else ""
 
-    def log(msg):
-        try:
-            print(msg)
-            write_log(msg)
-        except Exception:
-            pass
-
     # === CALL ===
     if event == "call":
-        args, _, _, values = inspect.getargvalues(frame)
+        # a callback per executed line dominated the harness run time; keep
+        # call/return/exception for this frame but turn its line events off
+        frame.f_trace_lines = False
+        co = frame.f_code
+        values = frame.f_locals
+        args = co.co_varnames[:co.co_argcount + co.co_kwonlyargcount]
         arg_str = ", ".join(f"{a}={short(values[a])}" for a in args if a in values)
-        header = f"\n{indent}{color('╭▶', 'cyan', 'bold')} {color(func, 'green', 'bold')}() {color(fmt_path(rel, frame.f_lineno), 'gray')} {ts}"
-        log(header)
+        log(_CALL_TMPL.format(indent=indent, func=func, path=fmt_path(rel, frame.f_lineno), ts=ts))
         if arg_str:
-            log(f"{indent}{color('│ args:', 'yellow')} {arg_str}")
-
-    # === LINE ===
-    elif event == "line":
-        line = linecache.getline(str(filename), frame.f_lineno).strip()
-        log(f"{indent}{color('│ →', 'cyan')} {color(line, 'reset')}")
-        local_vars = fmt_locals(frame.f_locals)
-        if local_vars:
-            log(f"{indent}{color('│ • locals:', 'gray')} {local_vars}")
+            log(_ARGS_TMPL.format(indent=indent, args=arg_str))
 
     # === RETURN ===
     elif event == "return":
-        msg = f"{indent}{color('╰↩', 'green', 'bold')} {color('return', 'gray')} {short(arg)} {ts}"
-        log(msg)
+        log(_RETURN_TMPL.format(indent=indent, value=short(arg), ts=ts))
+        _depth -= 1
 
     # === EXCEPTION ===
     elif event == "exception":
         exc_type, exc_value, _ = arg
-        msg = f"{indent}{color('💥', 'red', 'bold')} {exc_type.__name__}: {exc_value}  {color(fmt_path(rel, frame.f_lineno), 'gray')}"
-        log(msg)
+        log(_EXC_TMPL.format(indent=indent, exc=exc_type.__name__, value=exc_value, path=fmt_path(rel, frame.f_lineno)))
 
     return trace
 
-sys.settrace(trace)  # Re-enabled with improved error handling
+def install_tracer():
+    """Open the trace log, start its writer and trace this thread from here on."""
+    global _LOG_FH
+    _LOG_FH = open(LOG_PATH, "a", encoding="utf-8", buffering=1 << 16)
+    _log_thread.start()
+    atexit.register(_close_log)
+    sys.settrace(trace)
+
+if TRACE_ENABLED:
+    install_tracer()
+
+# === FIXED FRAMES ===
+# the same every run, so encoded once at import
+INTEGRATION_HELLO = orjson.dumps({
+    "game": "spotify",
+    "status": "ready"
+})
+WATCHER_HELLO = orjson.dumps({
+    "type": "neuro-os",
+    "name": "neuroos",
+    "auth_token": AUTH_TOKEN  # Neuro OS special token
+})
+WATCHER_STATUS = orjson.dumps({
+    "direct_to_neuro": True,
+    "payload": {
+        "op": "neuroos_status",
+        "message": "Neuro OS monitoring relay activity",
+        "timestamp": "2025-01-01T00:00:00Z"
+    }
+})
+WATCHER_PING = orjson.dumps({
+    "target": "spotify",
+    "cmd": {"action": "ping"}
+})
+NEURO_REQUEST = orjson.dumps({
+    "op": "choose_force_action",
+    "game_title": "TestGame",
+    "state": {},
+    "query": "Choose an action",
+    "ephemeral_context": {},
+    "actions": [{"name": "action1"}, {"name": "action2"}],
+})
 
 async def fake_integration():
     # Connect to Nakurity Backend (not Intermediary) - this is the correct pipeline
     uri = "ws://127.0.0.1:8001"
     async with websockets.connect(uri) as ws:
         # Send a startup message to identify as spotify integration
-        await ws.send(json.dumps({
-            "game": "spotify",
-            "status": "ready"
-        }))
+        await ws.send(INTEGRATION_HELLO, text=True)
         
         # listen for messages from Nakurity Backend
         # Listen for integration messages with timeout
@@ -160,8 +266,8 @@ async def fake_integration():
         try:
             async for msg in ws:
                 try:
-                    data = json.loads(msg)
-                    print(f"[Integration] received: {data}")
+                    data = orjson.loads(msg)
+                    logger.debug("[Integration] received: %s", data)
                     message_count += 1
                     
                     # Look for choose_action broadcast from Nakurity Backend
@@ -169,126 +275,118 @@ async def fake_integration():
                         payload = data["payload"]
                         if payload.get("type") == "choose_action_request" and payload.get("actions"):
                             choice = {
+                                "request_id": payload.get("request_id"),
                                 "choice": {
                                     "selected": payload["actions"][0]["name"],
                                     "data": {"volume": 50}
                                 }
                             }
-                            await ws.send(json.dumps(choice))
-                            print("[Integration] sent choice")
+                            await ws.send(orjson.dumps(choice), text=True)
+                            logger.info("[Integration] sent choice")
                             break
                     
                     # Exit after receiving a few messages
                     if message_count >= max_messages:
-                        print(f"[Integration] received {message_count} messages, exiting")
+                        logger.info("[Integration] received %d messages, exiting", message_count)
                         break
                         
-                except json.JSONDecodeError:
-                    print(f"[Integration] received non-JSON: {msg}")
+                except orjson.JSONDecodeError:
+                    logger.debug("[Integration] received non-JSON: %s", msg)
         except (websockets.exceptions.ConnectionClosed, websockets.exceptions.ConnectionClosedOK):
-            print("[Integration] connection closed")
+            logger.info("[Integration] connection closed")
 
 async def fake_watcher():
     uri = "ws://127.0.0.1:8765"
     async with websockets.connect(uri) as ws:
         # Use Neuro OS special auth token for enhanced privileges
-        await ws.send(json.dumps({
-            "type": "neuro-os",
-            "name": "neuroos",
-            "auth_token": "super-secret-token"  # Neuro OS special token
-        }))
+        await ws.send(WATCHER_HELLO, text=True)
         
         # Test direct message to Neuro backend (enhanced privilege)
         await asyncio.sleep(1)
-        await ws.send(json.dumps({
-            "direct_to_neuro": True,
-            "payload": {
-                "op": "neuroos_status",
-                "message": "Neuro OS monitoring relay activity",
-                "timestamp": "2025-01-01T00:00:00Z"
-            }
-        }))
-        print("[Neuro OS] sent direct message to Neuro backend")
+        await ws.send(WATCHER_STATUS, text=True)
+        logger.info("[Neuro OS] sent direct message to Neuro backend")
         
         # Regular integration command (may fail if integration disconnected)
         await asyncio.sleep(1)
-        await ws.send(json.dumps({
-            "target": "spotify", 
-            "cmd": {"action": "ping"}
-        }))
-        print("[Watcher] sent ping")
+        await ws.send(WATCHER_PING, text=True)
+        logger.info("[Watcher] sent ping")
         
         # Listen for a few messages then exit
         message_count = 0
         max_messages = 5
         try:
             async for msg in ws:
-                print("[Watcher] recv:", msg)
+                logger.debug("[Watcher] recv: %s", msg)
                 message_count += 1
                 if message_count >= max_messages:
-                    print(f"[Watcher] received {message_count} messages, exiting")
+                    logger.info("[Watcher] received %d messages, exiting", message_count)
                     break
         except (websockets.exceptions.ConnectionClosed, websockets.exceptions.ConnectionClosedOK):
-            print("[Watcher] connection closed")
+            logger.info("[Watcher] connection closed")
 
 async def fake_neuro_request():
     # Connect directly to the fake Neuro backend
     uri = "ws://127.0.0.1:8001"
     async with websockets.connect(uri) as ws:
         # simulate Neuro asking for an action
-        request = {
-            "op": "choose_force_action",
-            "game_title": "TestGame",
-            "state": {},
-            "query": "Choose an action",
-            "ephemeral_context": {},
-            "actions": [{"name": "action1"}, {"name": "action2"}],
-        }
-        await ws.send(json.dumps(request))
-        print("[Neuro] sent choose_force_action")
+        await ws.send(NEURO_REQUEST, text=True)
+        logger.info("[Neuro] sent choose_force_action")
         
         # Wait for response from relay
         try:
             response = await asyncio.wait_for(ws.recv(), timeout=10.0)
-            data = json.loads(response)
-            print(f"[Neuro] received response: {data}")
+            data = orjson.loads(response)
+            logger.debug("[Neuro] received response: %s", data)
         except asyncio.TimeoutError:
-            print("[Neuro] timeout waiting for response")
+            logger.info("[Neuro] timeout waiting for response")
         except (websockets.exceptions.ConnectionClosed, websockets.exceptions.ConnectionClosedOK):
-            print("[Neuro] connection closed before response")
-        except json.JSONDecodeError:
-            print(f"[Neuro] received non-JSON response: {response}")
+            logger.info("[Neuro] connection closed before response")
+        except orjson.JSONDecodeError:
+            logger.debug("[Neuro] received non-JSON response: %s", response)
+
+TEST_TIMEOUT = 20.0  # per fake client
+
+async def run_timed(name, coro, failed):
+    # a timeout only ends this client; the others keep running and report on their own
+    try:
+        await asyncio.wait_for(coro, timeout=TEST_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("[Test Harness] %s timed out after %g seconds", name, TEST_TIMEOUT)
+        failed.append(name)
 
 async def run_all():
-    print("[Test Harness] Starting relay integration tests...")
+    """Run every fake client; returns the names of those that timed out or errored."""
+    logger.info("[Test Harness] Starting relay integration tests...")
     await asyncio.sleep(2)  # wait for servers to start
     
+    failed = []
     try:
-        await asyncio.wait_for(
-            asyncio.gather(
-                fake_integration(),
-                fake_watcher(),
-                fake_neuro_request()
-            ),
-            timeout=30.0  # 30 second timeout for all tests
-        )
-        print("[Test Harness] All tests completed successfully")
-    except asyncio.TimeoutError:
-        print("[Test Harness] Tests timed out after 30 seconds")
-    except Exception as e:
-        print(f"[Test Harness] Tests failed with error: {e}")
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(run_timed("integration", fake_integration(), failed), name="integration")
+            tg.create_task(run_timed("watcher", fake_watcher(), failed), name="watcher")
+            tg.create_task(run_timed("neuro", fake_neuro_request(), failed), name="neuro")
+        if not failed:
+            logger.info("[Test Harness] All tests completed")
+    except* Exception as eg:
+        for e in eg.exceptions:
+            logger.error("[Test Harness] Tests failed with error: %r", e)
+        failed.append("error")
     finally:
-        print("[Test Harness] Test run finished")
+        logger.info("[Test Harness] Test run finished")
+    return failed
 
 if __name__ == "__main__":
-    import sys
+    logging.basicConfig(level=os.getenv("RELAY_LOG", "INFO").upper(), format="%(message)s")
     try:
-        asyncio.run(run_all())
-        print("[Test Harness] Exiting successfully")
+        failed = asyncio.run(run_all())
+        if failed:
+            logger.error("[Test Harness] Failed: %s", ", ".join(failed))
+            sys.exit(1)
+        logger.info("[Test Harness] Exiting successfully")
         sys.exit(0)
     except KeyboardInterrupt:
-        print("[Test Harness] Interrupted by user")
+        logger.info("[Test Harness] Interrupted by user")
         sys.exit(1)
     except Exception as e:
-        print(f"[Test Harness] Fatal error: {e}")
+        logger.error("[Test Harness] Fatal error: %s", e)
         sys.exit(1)
@@ -14,8 +14,8 @@ import os
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
 
 from dev.nakurity.client import NakurityClient
-from dev.nakurity.intermediary import Intermediary
-from dev.nakurity.server import NakurityBackend
+from dev.nakurity.intermediary import Intermediary, ConnectionMap
+from dev.nakurity.server import NakurityBackend, CLIENT_OUTBOX_SIZE
 from dev.nakurity.linker import NakurityLink
 
 class TestNakurityClient:
@@ -120,8 +120,117 @@ class TestIntermediary:
         test_message = {"event": "test", "data": "test_data"}
         await intermediary._notify_watchers(test_message)
         
-        mock_watcher.send.assert_called_once_with(json.dumps(test_message))
+        mock_watcher.send.assert_called_once()
+        sent = mock_watcher.send.call_args.args[0]
+        assert json.loads(sent) == test_message
+
+    @pytest.mark.asyncio
+    async def test_notify_watchers_drops_failed_watcher(self):
+        """Test a watcher whose send fails is removed while others still receive"""
+        intermediary = Intermediary("127.0.0.1", 8765)
+
+        good_watcher = AsyncMock()
+        dead_watcher = AsyncMock()
+        dead_watcher.send.side_effect = ConnectionError("gone")
+        intermediary.watchers["good"] = good_watcher
+        intermediary.watchers["dead"] = dead_watcher
+
+        await intermediary._notify_watchers({"event": "test"})
+
+        good_watcher.send.assert_called_once()
+        assert "good" in intermediary.watchers
+        assert "dead" not in intermediary.watchers
+
+    @pytest.mark.asyncio
+    async def test_notify_watchers_accepts_encoded_frame(self):
+        """Test a pre-encoded frame is sent to watchers as-is"""
+        intermediary = Intermediary("127.0.0.1", 8765)
+        mock_watcher = AsyncMock()
+        intermediary.watchers["test_watcher"] = mock_watcher
+        
+        await intermediary._notify_watchers(b'{"event":"test"}')
+        
+        assert mock_watcher.send.call_args.args[0] == b'{"event":"test"}'
+
+    def test_connection_map_snapshot_invalidated(self):
+        """Test every way of changing a ConnectionMap refreshes its snapshot"""
+        conns = ConnectionMap()
+        conns["a"] = 1
+        assert conns.snapshot() == (("a", 1),)
+
+        conns |= {"b": 2}
+        assert conns.snapshot() == (("a", 1), ("b", 2))
+        conns.pop("a")
+        assert conns.snapshot() == (("b", 2),)
+
+    @pytest.mark.asyncio
+    async def test_register_rejects_invalid_token(self):
+        """Test registration with a wrong auth token is refused"""
+        intermediary = Intermediary("127.0.0.1", 8765)
+        mock_ws = AsyncMock()
+        mock_ws.recv.return_value = json.dumps({
+            "type": "integration",
+            "name": "intruder",
+            "auth_token": "wrong-token"
+        })
+        
+        result = await intermediary._register(mock_ws)
+        
+        assert result is None
+        assert "intruder" not in intermediary.integrations
+        mock_ws.send.assert_called_once()
+        assert json.loads(mock_ws.send.call_args.args[0]) == {"error": "invalid auth token"}
+    
+    @pytest.mark.asyncio
+    async def test_register_rejects_oversized_frame(self):
+        """Test an oversized registration frame is refused without registering"""
+        intermediary = Intermediary("127.0.0.1", 8765)
+        mock_ws = AsyncMock()
+        mock_ws.recv.return_value = "{" + " " * 10000 + "}"
+        
+        result = await intermediary._register(mock_ws)
+        
+        assert result is None
+        mock_ws.send.assert_not_called()
+        mock_ws.close.assert_called_once_with(code=1009, reason="registration too large")
     
+    @pytest.mark.asyncio
+    async def test_register_accepts_valid_token(self):
+        """Test registration with the configured auth token succeeds"""
+        intermediary = Intermediary("127.0.0.1", 8765)
+        mock_ws = AsyncMock()
+        mock_ws.recv.return_value = json.dumps({
+            "type": "integration",
+            "name": "spotify",
+            "auth_token": "super-secret-token"
+        })
+        
+        result = await intermediary._register(mock_ws)
+        
+        assert result == {"type": "integration", "name": "spotify"}
+        assert intermediary.integrations["spotify"] == mock_ws
+
+    @pytest.mark.asyncio
+    async def test_queued_messages_flushed_on_register(self, tmp_path):
+        """Test messages queued for an offline integration are sent when it registers"""
+        with patch("dev.nakurity.intermediary.QUEUE_FILE", tmp_path / "queue.jsonl"):
+            intermediary = Intermediary("127.0.0.1", 8765)
+            await intermediary.send_to_integration("spotify", {"n": 1})
+            await intermediary.send_to_integration("spotify", {"n": 2})
+            assert len(intermediary.pending["spotify"]) == 2
+
+            mock_ws = AsyncMock()
+            mock_ws.recv.return_value = json.dumps({
+                "type": "integration",
+                "name": "spotify",
+                "auth_token": "super-secret-token"
+            })
+            await intermediary._register(mock_ws)
+
+        sent = [json.loads(c.args[0]) for c in mock_ws.send.call_args_list]
+        assert sent == [{"n": 1}, {"n": 2}]
+        assert "spotify" not in intermediary.pending
+
     def test_register_action(self):
         """Test action registration"""
         intermediary = Intermediary("127.0.0.1", 8765)
@@ -188,10 +297,8 @@ class TestNakurityBackend:
         message = "test message"
         reply_if_not_busy = True
         
-        backend.add_context(game_title, message, reply_if_not_busy)
-        
-        # Wait for the async task to be created
-        await asyncio.sleep(0.1)
+        task = backend.add_context(game_title, message, reply_if_not_busy)
+        await task
         
         # Verify intermediary was notified
         mock_intermediary._notify_watchers.assert_called()
@@ -201,6 +308,95 @@ class TestNakurityBackend:
         assert args["message"] == message
         assert args["reply_if_not_busy"] == reply_if_not_busy
     
+    @pytest.mark.asyncio
+    async def test_submit_call_async_soon_runs_coroutine(self, mock_intermediary):
+        """Test scheduled coroutine functions are actually run on the loop"""
+        backend = NakurityBackend(mock_intermediary)
+        called = asyncio.Event()
+        
+        async def scheduled():
+            called.set()
+        
+        await backend.submit_call_async_soon(scheduled)
+        await asyncio.wait_for(called.wait(), timeout=1.0)
+    
+    @pytest.mark.asyncio
+    async def test_add_context_without_watchers(self, mock_intermediary):
+        """Test add_context does nothing when no watcher is connected"""
+        mock_intermediary.watchers = {}
+        backend = NakurityBackend(mock_intermediary)
+        
+        task = backend.add_context("test_game", "test message", False)
+        
+        assert task is None
+        mock_intermediary._notify_watchers.assert_not_called()
+    
+    @pytest.mark.asyncio
+    async def test_write_to_websocket_drops_failed_client(self, mock_intermediary):
+        """Test backend writes reach every client and failing clients are removed"""
+        backend = NakurityBackend(mock_intermediary)
+        good_client = AsyncMock()
+        dead_client = AsyncMock()
+        dead_client.send.side_effect = ConnectionError("gone")
+        backend._add_client("good", good_client)
+        backend._add_client("dead", dead_client)
+        
+        await backend.write_to_websocket('{"command": "test"}')
+        await asyncio.sleep(0)
+        
+        good_client.send.assert_called_once_with('{"command": "test"}')
+        assert list(backend.clients) == ["good"]
+        backend._drop_client(backend.clients["good"])
+    
+    @pytest.mark.asyncio
+    async def test_slow_client_outbox_drops_oldest(self, mock_intermediary):
+        """Test a client that stops reading keeps only the newest frames queued"""
+        backend = NakurityBackend(mock_intermediary)
+        stalled = asyncio.Event()
+        
+        async def never_returns(data):
+            await stalled.wait()
+        
+        slow_client = AsyncMock()
+        slow_client.send.side_effect = never_returns
+        conn = backend._add_client("slow", slow_client)
+        await backend.write_to_websocket("stuck")
+        await asyncio.sleep(0)
+        
+        for i in range(CLIENT_OUTBOX_SIZE + 10):
+            await backend.write_to_websocket(str(i))
+        
+        assert conn._outbox.qsize() == CLIENT_OUTBOX_SIZE
+        assert conn._outbox.get_nowait() == "10"
+        backend._drop_client(conn)
+
+    @pytest.mark.asyncio
+    async def test_action_send_failure_returns_error(self, mock_intermediary):
+        """Test an action that can't be written reports the failure instead of waiting"""
+        backend = NakurityBackend(mock_intermediary)
+        dead_client = AsyncMock()
+        dead_client.send.side_effect = ConnectionError("gone")
+        conn = backend._add_client("game", dead_client)
+
+        reply = await backend._handle_intermediary_forward({"payload": {"action": "game.jump", "data": "{}"}})
+
+        assert reply == {"error": "failed to send to game"}
+        backend._drop_client(conn)
+
+    @pytest.mark.asyncio
+    async def test_action_result_wait_ends_on_disconnect(self, mock_intermediary):
+        """Test a client dropping before answering an action doesn't hang the forward"""
+        backend = NakurityBackend(mock_intermediary)
+        conn = backend._add_client("game", AsyncMock())
+
+        pending = asyncio.create_task(backend._handle_intermediary_forward(
+            {"payload": {"action": "game.jump", "data": "{}"}}
+        ))
+        await asyncio.sleep(0)
+        backend._drop_client(conn)
+
+        assert await asyncio.wait_for(pending, 1.0) == {"error": "no result from game"}
+
     @pytest.mark.asyncio
     async def test_choose_force_action(self, mock_intermediary):
         """Test forced action choice"""
@@ -225,6 +421,52 @@ class TestNakurityBackend:
         # Should return fallback action
         assert result[0] == "action1"
         assert result[1] == "{}"
+    
+    @pytest.mark.asyncio
+    async def test_choose_force_action_uses_integration_choice(self, mock_intermediary):
+        """Test an integration's choice resolves the matching pending request"""
+        backend = NakurityBackend(mock_intermediary)
+        mock_action1 = Mock()
+        mock_action1.name = "action1"
+        mock_action1.desc = ""
+        mock_action2 = Mock()
+        mock_action2.name = "action2"
+        mock_action2.desc = ""
+        
+        pending = asyncio.create_task(backend.choose_force_action(
+            game_title="test_game",
+            state={},
+            query="Choose action",
+            ephemeral_context={},
+            actions=[mock_action1, mock_action2]
+        ))
+        await asyncio.sleep(0)
+        request_id = next(iter(backend._pending_choices))
+        
+        reply = await backend._handle_intermediary_forward({"payload": {
+            "request_id": request_id,
+            "choice": {"selected": "action2", "data": {"volume": 50}}
+        }})
+        
+        assert reply == {"accepted": True}
+        name, data = await pending
+        assert name == "action2"
+        assert json.loads(data) == {"volume": 50}
+        assert backend._pending_choices == {}
+
+    def test_resolve_integration_for_action(self):
+        """Test actions resolve to the integration that last registered them"""
+        intermediary = Intermediary("127.0.0.1", 8765)
+        backend = NakurityBackend(intermediary)
+        
+        intermediary.record_actions("game", [{"name": "jump"}, {"name": "play"}])
+        intermediary.record_actions("spotify", {"playlist_add": {}})
+        intermediary.record_actions("game", [{"name": "jump"}])
+        
+        assert backend._resolve_integration_for_action("jump") == "game"
+        assert backend._resolve_integration_for_action("playlist_add") == "spotify"
+        assert backend._resolve_integration_for_action("play") is None
+        assert backend._resolve_integration_for_action("spotify.pause") == "spotify"
 
 class TestNakurityLink:
     """Test NakurityLink functionality"""
@@ -257,10 +499,10 @@ class TestNakurityLink:
         await link.register_actions({"actions": test_actions})
         
         # Should add to traffic queue
-        assert not link.traffic.empty()
+        assert link.traffic
         
         # Get the traffic item
-        item = await link.traffic.get()
+        item = link.traffic.popleft()
         assert item["type"] == "register_actions"
         assert item["payload"] == test_actions
     
@@ -278,15 +520,31 @@ class TestNakurityLink:
         await link.send_event(test_data)
         
         # Should add to traffic queue
-        assert not link.traffic.empty()
+        assert link.traffic
         
         # Get the traffic item
-        item = await link.traffic.get()
+        item = link.traffic.popleft()
         assert item["type"] == "event"
         assert item["event"] == "test_event"
         assert item["from"] == "test_integration"
         assert item["payload"] == {"test": "data"}
 
+    @pytest.mark.asyncio
+    async def test_queued_registrations_merged(self, mock_client):
+        """Test back-to-back action registrations go out as one actions/register"""
+        link = NakurityLink(mock_client)
+        
+        await link.register_actions({"actions": [{"name": "a"}]})
+        await link.register_actions({"actions": [{"name": "b"}]})
+        await link.start()
+        await asyncio.sleep(0)
+        await link.stop()
+        
+        mock_client.send_command_data.assert_called_once()
+        frame = json.loads(mock_client.send_command_data.call_args.args[0])
+        assert frame["command"] == "actions/register"
+        assert frame["data"]["actions"] == [{"name": "a"}, {"name": "b"}]
+
 class TestIntegration:
     """Integration tests for component interactions"""
     
@@ -24,7 +24,7 @@ class ConfigLoader:
         """Load configuration from YAML file"""
         try:
             with open(self.config_path, 'r') as f:
-                config = yaml.safe_load(f)
+                config = yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
             return config if config else {}
         except FileNotFoundError:
             print(f"Config file not found: {self.config_path}")
@@ -72,6 +72,17 @@ class ConfigLoader:
         """Get performance configuration"""
         return self.config.get("performance", {})
     
+    def get_websocket_options(self, compression_key: str = "compression",
+                              compression_default: Optional[str] = None) -> Dict[str, Any]:
+        """Keyword arguments for websockets.connect/serve from performance.websocket"""
+        ws_config = self.get_performance_config().get("websocket", {})
+        return {
+            "ping_interval": ws_config.get("ping_interval", 20),
+            "ping_timeout": ws_config.get("ping_timeout", 20),
+            "max_size": ws_config.get("max_message_size", 2 ** 20),
+            "compression": ws_config.get(compression_key, compression_default),
+        }
+    
     def setup_logging(self) -> None:
         """Setup logging based on configuration"""
         log_config = self.get_logging_config()
@@ -146,6 +157,11 @@ def is_trace_enabled() -> bool:
     """Quick check if tracing is enabled"""
     return get_config_loader().is_trace_enabled()
 
+def get_websocket_options(compression_key: str = "compression",
+                          compression_default: Optional[str] = None) -> Dict[str, Any]:
+    """Quick access to websocket connection options"""
+    return get_config_loader().get_websocket_options(compression_key, compression_default)
+
 def setup_logging() -> None:
     """Setup logging from configuration"""
     get_config_loader().setup_logging()
@@ -1,29 +1,27 @@
+from functools import lru_cache
 from pathlib import Path
 import yaml
 
+# libyaml-backed loader when PyYAML was built with it; same safe subset either way
+_SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# this file lives at <root>/src/dev/utils/loadconfig.py
+PROJECT_ROOT = Path(__file__).resolve().parents[3]
+
 # ---------------------------
 # Load configuration from YAML
 # ---------------------------
+@lru_cache(maxsize=1)
 def load_config():
-    # Get the directory of this script
-    current_dir = Path(__file__).resolve().parent
-
-    # Walk upward until we find "neuro-relay" folder (the project root)
-    for parent in current_dir.parents:
-        if parent.name == "neuro-relay":
-            project_root = parent
-            break
-    else:
-        raise RuntimeError("Could not locate 'windows-api' directory above this file.")
-
+    # Parsed once per process; callers share the result and must not mutate it.
     # Build path to the YAML config file
-    config_path = project_root / "src" / "resources" / "authentication.yaml"
+    config_path = PROJECT_ROOT / "src" / "resources" / "authentication.yaml"
 
     if not config_path.exists():
         raise FileNotFoundError(f"Config file not found at: {config_path}")
 
     with open(config_path, "r", encoding="utf-8") as f:
-        return yaml.safe_load(f)
+        return yaml.load(f, Loader=_SafeLoader)
 
 # cfg = load_config()
 
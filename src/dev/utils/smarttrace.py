@@ -0,0 +1,159 @@
+"""
+SmartTrace: a verbose sys.settrace tracer for debugging the relay.
+
+Only imported by the entrypoint when tracing is enabled (debug.trace.enabled in
+config.yaml, or NAKURITY_TRACE=1), so normal runs never pay for it.
+"""
+
+import os
+import re
+import atexit
+import linecache
+import inspect
+import time
+from pathlib import Path
+
+# === CONFIGURATION ===
+PROJECT_ROOT = Path(__file__).parents[2].resolve()
+LOG_PATH = PROJECT_ROOT / "trace_debug.log"
+
+USE_COLOR = True
+SHOW_FILE_PATH = False
+SHOW_TIMESTAMP = True
+MAX_VALUE_LEN = 60
+MAX_LOCALS = 4
+MAX_STACK_DEPTH = 12
+
+start_time = time.perf_counter()
+
+# === COLOR UTILITIES ===
+COLOR_CODES = {
+    "reset": "\033[0m", "bold": "\033[1m",
+    "gray": "\033[90m", "red": "\033[91m",
+    "green": "\033[92m", "yellow": "\033[93m",
+    "blue": "\033[94m", "magenta": "\033[95m",
+    "cyan": "\033[96m",
+}
+RESET = COLOR_CODES["reset"]
+
+def color(txt, fg=None, style=None):
+    if not USE_COLOR:
+        return txt
+    return f"{COLOR_CODES.get(style, '')}{COLOR_CODES.get(fg, '')}{txt}{RESET}"
+
+# === FORMATTING HELPERS ===
+def short(v):
+    s = repr(v)
+    return s if len(s) <= MAX_VALUE_LEN else s[:MAX_VALUE_LEN - 3] + "..."
+
+def now():
+    return f"{(time.perf_counter() - start_time):6.3f}s"
+
+def fmt_path(rel, lineno):
+    if SHOW_FILE_PATH:
+        return f"{rel}:{lineno}"
+    return f"{rel.name}:{lineno}"
+
+def fmt_locals(locals_dict):
+    items = [
+        f"{color(k, 'blue')}={color(short(v), 'gray')}"
+        for k, v in locals_dict.items()
+        if not k.startswith("__") and not inspect.isfunction(v)
+    ]
+    return ", ".join(items[:MAX_LOCALS])
+
+# === LOG OUTPUT ===
+# The log fd is opened once and lines are written in batches; opening the
+# file per traced event turns every call/line into an open/write/close.
+LOG_FLUSH_LINES = 256
+LOG_FD = os.open(LOG_PATH, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+_log_buf: list[str] = []
+
+def flush_log():
+    if _log_buf:
+        os.write(LOG_FD, ("\n".join(_log_buf) + "\n").encode("utf-8"))
+        _log_buf.clear()
+
+def write_log(line):
+    _log_buf.append(line)
+    if len(_log_buf) >= LOG_FLUSH_LINES:
+        flush_log()
+
+atexit.register(flush_log)
+
+# === MAIN TRACER ===
+TRACE_INCLUDE = ["src/dev/nakurity", "src/dev/tests"]
+TRACE_EVENTS = {"call", "return", "exception", "line"}  # include line events for verbose debugging
+TRACE_EXCLUDE_FUNCS = {"write_log", "flush_log", "trace"}
+
+def plain(txt):
+    """Strip ANSI codes for file output."""
+    return re.sub(r"\x1b\[[0-9;]*m", "", txt)
+
+def trace(frame, event, arg):
+    try:
+        filename = Path(frame.f_code.co_filename).resolve()
+    except Exception:
+        return
+
+    try:
+        filename.relative_to(PROJECT_ROOT)
+    except ValueError:
+        return
+
+    rel = filename.relative_to(PROJECT_ROOT)
+    rel_posix = rel.as_posix()
+    func = frame.f_code.co_name
+    depth = len(inspect.stack(0)) - 1
+    indent = "│  " * (depth % MAX_STACK_DEPTH)
+    ts = f"[{now()}]" if SHOW_TIMESTAMP else ""
+
+    def log(msg, newline=False):
+        clean = plain(msg)
+        if newline:
+            print()
+            write_log("")
+        print(msg)
+        write_log(clean)
+
+    # === CALL ===
+    if event == "call":
+        args, _, _, values = inspect.getargvalues(frame)
+        arg_str = ", ".join(f"{a}={short(values[a])}" for a in args if a in values)
+        header = (
+            f"\n{indent}{color('╭▶', 'cyan', 'bold')} "
+            f"{color(func, 'green', 'bold')}() "
+            f"{color(fmt_path(rel, frame.f_lineno), 'gray')} {ts}"
+        )
+        log(header, newline=True)
+        if arg_str:
+            log(f"{indent}{color('│ args:', 'yellow')} {arg_str}")
+
+    # === LINE ===
+    elif event == "line":
+        line = linecache.getline(str(filename), frame.f_lineno).strip()
+        msg = f"{indent}{color('│ →', 'cyan')} {line}"
+        log(msg)
+        local_vars = fmt_locals(frame.f_locals)
+        if local_vars:
+            log(f"{indent}{color('│ • locals:', 'gray')} {local_vars}")
+
+    # === RETURN ===
+    elif event == "return":
+        msg = (
+            f"{indent}{color('╰↩', 'green', 'bold')} "
+            f"{color('return', 'gray')} {short(arg)} {ts}"
+        )
+        log(msg)
+
+    # === EXCEPTION ===
+    elif event == "exception":
+        exc_type, exc_value, _ = arg
+        msg = (
+            f"{indent}{color('💥', 'red', 'bold')} "
+            f"{exc_type.__name__}: {exc_value}  "
+            f"{color(fmt_path(rel, frame.f_lineno), 'gray')}"
+        )
+        log(msg, newline=True)
+
+    return trace